@@ -1,16 +1,58 @@
 import pandas as pd
-import collections
+import numpy as np
+from scipy import sparse
 
+from diffusion_store import DiffusionStore, as_frame, iter_frames, map_store
+from user_index import as_codes
 
-def label_retweets_by_content(cascade_df, classification_df):
-    """Attach manual labels to cascades based on the `ref` (original post)."""
+
+def _store_out_dir(out_dir):
+    if out_dir is None:
+        raise ValueError("Enriching a DiffusionStore writes a new store; pass out_dir")
+    return out_dir
+
+
+def label_retweets_by_content(cascade_df, classification_df, out_dir=None):
+    """
+    Attach manual labels to cascades based on the `ref` (original post).
+    A `DiffusionStore` is labelled partition by partition into a new store in `out_dir`.
+    """
+    if isinstance(cascade_df, DiffusionStore):
+        return map_store(cascade_df, label_retweets_by_content, _store_out_dir(out_dir),
+                         classification_df=classification_df)
     label_map = classification_df.groupby("post")["label_manual"].first().to_dict()
     cascade_df["label"] = cascade_df["ref"].map(label_map)
     return cascade_df
 
 
-def assign_modularity_groups(cascade_df, user_modularity_df):
-    """Attach modularity class info to Source, Target, Refuser (O) users."""
+def assign_modularity_groups(cascade_df, user_modularity_df, user_index=None, out_dir=None):
+    """
+    Attach modularity class info to Source, Target, Refuser (O) users.
+    With a `UserIndex`, users are matched on integer codes through an array lookup;
+    Ids missing from the index are added first, so any index (even an empty one) works.
+    A `DiffusionStore` is processed partition by partition into a new store in `out_dir`;
+    there the classes are written as strings (like the "999" default), so every
+    partition has the same column type whatever the type of `modularity_class`.
+    """
+    if isinstance(cascade_df, DiffusionStore):
+        return map_store(cascade_df, _assign_modularity_partition, _store_out_dir(out_dir),
+                         user_modularity_df=user_modularity_df, user_index=user_index)
+    if user_index is not None:
+        # Encode the Id table first: cascade users unknown to the index then have no class
+        ids = as_codes(user_modularity_df["Id"], user_index, add=True)
+        mods = user_modularity_df["modularity_class"].to_numpy()
+        # groupby().first() takes the first non-null class per Id (NaN if there is none)
+        valid = pd.notna(mods) & (ids >= 0)
+        first = pd.Series(mods[valid]).groupby(ids[valid], sort=False).first()
+        # the extra last slot holds the default for unknown users (code -1)
+        mod_table = np.full(len(user_index) + 1, "999", dtype=object)
+        mod_table[ids[ids >= 0]] = np.nan
+        mod_table[first.index.to_numpy()] = first.to_numpy()
+        for col in ["Source", "Target", "refu"]:
+            codes = as_codes(cascade_df[col], user_index)
+            cascade_df[f"{col[0]}_modularity"] = mod_table[np.where(codes < 0, len(user_index), codes)]
+        return cascade_df
+
     mod_map = user_modularity_df.groupby("Id")["modularity_class"].first().to_dict()
 
     for col in ["Source", "Target", "refu"]:
@@ -20,10 +62,33 @@ def assign_modularity_groups(cascade_df, user_modularity_df):
     return cascade_df
 
 
-def mark_top_users(cascade_df, centrality_df, top_k=0.01):
-    """Mark top-k% users by centrality as 'top' in Source/Target columns."""
+def _assign_modularity_partition(cascade_df, user_modularity_df, user_index=None):
+    cascade_df = assign_modularity_groups(cascade_df, user_modularity_df, user_index)
+    for col in ["S_modularity", "T_modularity", "r_modularity"]:
+        cascade_df[col] = cascade_df[col].astype("string")
+    return cascade_df
+
+
+def mark_top_users(cascade_df, centrality_df, top_k=0.01, user_index=None, out_dir=None):
+    """
+    Mark top-k% users by centrality as 'top' in Source/Target columns.
+    With a `UserIndex`, membership is tested on integer codes (top Ids missing from
+    the index are added to it).
+    A `DiffusionStore` is processed partition by partition into a new store in `out_dir`.
+    """
+    if isinstance(cascade_df, DiffusionStore):
+        return map_store(cascade_df, mark_top_users, _store_out_dir(out_dir),
+                         centrality_df=centrality_df, top_k=top_k, user_index=user_index)
     top_n = int(len(centrality_df) * top_k)
-    top_users = set(centrality_df.sort_values(by='eigencentrality', ascending=False).head(top_n)["Id"])
+    top_ids = centrality_df.sort_values(by='eigencentrality', ascending=False).head(top_n)["Id"]
+
+    if user_index is not None:
+        top_codes = as_codes(top_ids, user_index, add=True)
+        cascade_df["S_top"] = np.isin(as_codes(cascade_df["Source"], user_index), top_codes[top_codes >= 0]).astype(int)
+        cascade_df["T_top"] = np.isin(as_codes(cascade_df["Target"], user_index), top_codes[top_codes >= 0]).astype(int)
+        return cascade_df
+
+    top_users = set(top_ids)
 
     cascade_df["S_top"] = cascade_df["Source"].isin(top_users).astype(int)
     cascade_df["T_top"] = cascade_df["Target"].isin(top_users).astype(int)
@@ -31,35 +96,299 @@ def mark_top_users(cascade_df, centrality_df, top_k=0.01):
     return cascade_df
 
 
+class CascadeSummary:
+    """
+    Summary engine for a diffusion frame. Each column is converted to integer
+    codes once (on first use) and every statistic is a `np.bincount` over codes,
+    so no filtered copies of the frame are made.
+    """
+
+    def __init__(self, cascade_df):
+        self.df = cascade_df
+        self.n = len(cascade_df)
+        self._codes = {}
+
+    def codes(self, col):
+        """(codes, uniques) of a column in order of appearance; missing values get -1."""
+        if col not in self._codes:
+            self._codes[col] = pd.factorize(self.df[col])
+        return self._codes[col]
+
+    def code_of(self, col, value):
+        """Code of `value` in `col`, or -1 if it does not occur."""
+        uniques = self.codes(col)[1]
+        matches = np.flatnonzero(uniques == value)
+        return int(matches[0]) if len(matches) else -1
+
+    def group_codes(self, group_col):
+        """Like `codes`, but missing values form one group of their own at their first appearance."""
+        codes, uniques = self.codes(group_col)
+        if (codes < 0).any():
+            codes, uniques = pd.factorize(self.df[group_col], use_na_sentinel=False)
+        return codes, uniques
+
+    def group_distribution(self, group_col):
+        codes, uniques = self.group_codes(group_col)
+        counts = np.bincount(codes, minlength=len(uniques))
+        count_df = pd.DataFrame({group_col: uniques, "count": counts})
+        count_df["percent"] = count_df["count"] / self.n
+        return count_df
+
+    def in_group_mask(self):
+        """Rows whose source and target modularity are equal (missing never matches)."""
+        source, target = self.df["S_modularity"], self.df["T_modularity"]
+        codes, _ = pd.factorize(pd.concat([source, target], ignore_index=True))
+        s_codes, t_codes = codes[:self.n], codes[self.n:]
+        return (s_codes == t_codes) & (s_codes >= 0)
+
+    def direct_mask(self, saw_col="sawgu"):
+        code = self.code_of(saw_col, "direct")
+        if code < 0:
+            return np.zeros(self.n, dtype=bool)
+        return self.codes(saw_col)[0] == code
+
+    def in_group_sharing_rate(self):
+        return int(self.in_group_mask().sum()) / self.n
+
+    def direct_exposure_rate(self, saw_col="sawgu"):
+        return int(self.direct_mask(saw_col).sum()) / self.n
+
+    def indirect_mask(self, saw_col="sawgu"):
+        return ~self.direct_mask(saw_col) & (self.df["level"] == 0).to_numpy()
+
+    def indirect_exposure_rate(self, saw_col="sawgu"):
+        return int(self.indirect_mask(saw_col).sum()) / self.n
+
+    def exposure_counts(self, group_col="S_modularity", saw_col="sawgu"):
+        """
+        Rows per (group, exposure source) pair and the row position of its first
+        occurrence; additive across batches (see `merge_exposure_counts`).
+        """
+        groups, group_values = self.codes(group_col)
+        sources, source_values = pd.factorize(self.df[saw_col], use_na_sentinel=False)
+        n_sources = max(len(source_values), 1)
+        rows = np.flatnonzero(groups >= 0)
+        pairs = groups[rows].astype(np.int64) * n_sources + sources[rows]
+        keys, first, counts = np.unique(pairs, return_index=True, return_counts=True)
+        return pd.DataFrame({
+            "group": group_values[keys // n_sources],
+            "source": source_values[keys % n_sources],
+            "count": counts,
+            "first": rows[first],
+        })
+
+    def top_exposure(self, group_col="S_modularity", saw_col="sawgu", top_n=5):
+        """Top N exposure sources per group, ties broken by first appearance."""
+        return rank_exposures(self.exposure_counts(group_col, saw_col), top_n)
+
+    def cluster_counts(self, cluster_col="nr", group_col="S_modularity", saw_col="sawgu"):
+        """
+        Per-cluster sums behind every rate: a sparse (clusters x statistics) count matrix
+        and the number of rows per cluster. The statistics are the in-group, direct and
+        indirect counts followed by one count per group of `group_col`.
+        """
+        clusters, cluster_values = self.codes(cluster_col)
+        groups, group_values = self.group_codes(group_col)
+        flags = [self.in_group_mask(), self.direct_mask(saw_col), self.indirect_mask(saw_col)]
+        rows = np.concatenate([clusters[flag] for flag in flags] + [clusters])
+        cols = np.concatenate([np.full(int(flag.sum()), i) for i, flag in enumerate(flags)] + [len(flags) + groups])
+        counts = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                                   shape=(len(cluster_values), len(flags) + len(group_values)))
+        return counts, np.bincount(clusters, minlength=len(cluster_values)).astype(float)
+
+    def bootstrap(self, n_boot=10_000, ci=0.95, seed=None, cluster_col="nr", group_col="S_modularity",
+                  saw_col="sawgu", max_weights=4_000_000):
+        """
+        Percentile CIs for the three rates and the group shares, resampling whole clusters
+        (cascades). Each replicate draws multinomial cluster weights (counts of resampled
+        cluster ids) and re-weights the precomputed per-cluster counts, so the frame is
+        never resampled.
+
+        The cost is linear in n_boot x n_clusters resampled ids, about 20 s per 10^9 on
+        one core: 10k replicates take ~20 s over 100k cascades, ~45 s over 200k and
+        several minutes over millions; lower `n_boot` for quick looks. Replicates are
+        drawn in batches of about `max_weights` ids, using ~12 bytes of temporary
+        memory per id (int32 ids and float64 weights), ~50 MB by default.
+
+        Returns (rates, group_distribution): the rates as [statistic, estimate, low, high]
+        and the `group_distribution` table with `low` and `high` percent columns.
+        """
+        counts, sizes = self.cluster_counts(cluster_col, group_col, saw_col)
+        counts_t = counts.T.tocsr()
+        n_clusters = len(sizes)
+        rng = np.random.default_rng(seed)
+        batch = max(1, max_weights // max(n_clusters, 1))
+        replicates = np.empty((n_boot, counts.shape[1]))
+        weights = np.empty((min(batch, n_boot), n_clusters))
+        for lo in range(0, n_boot, batch):
+            b = min(batch, n_boot - lo)
+            draws = rng.integers(0, n_clusters, size=(b, n_clusters), dtype=np.int32)
+            for r in range(b):
+                weights[r] = np.bincount(draws[r], minlength=n_clusters)
+            replicates[lo:lo + b] = (counts_t @ weights[:b].T / (weights[:b] @ sizes)).T
+        alpha = (1 - ci) / 2
+        low, high = np.quantile(replicates, [alpha, 1 - alpha], axis=0)
+
+        rates = pd.DataFrame({
+            "statistic": ["in_group_sharing_rate", "direct_exposure_rate", "indirect_exposure_rate"],
+            "estimate": [self.in_group_sharing_rate(), self.direct_exposure_rate(saw_col),
+                         self.indirect_exposure_rate(saw_col)],
+            "low": low[:3],
+            "high": high[:3],
+        })
+        distribution = self.group_distribution(group_col)
+        distribution["low"] = low[3:]
+        distribution["high"] = high[3:]
+        return rates, distribution
+
+    def summary(self, group_col="S_modularity", saw_col="sawgu", top_n=5):
+        """All summary tables and rates computed from the shared codes."""
+        return {
+            "group_distribution": self.group_distribution(group_col),
+            "in_group_sharing_rate": self.in_group_sharing_rate(),
+            "direct_exposure_rate": self.direct_exposure_rate(saw_col),
+            "indirect_exposure_rate": self.indirect_exposure_rate(saw_col),
+            "top_exposure": self.top_exposure(group_col, saw_col, top_n),
+        }
+
+
+def rank_exposures(counts, top_n=5):
+    """
+    Turn `exposure_counts` into the `groupwise_top_exposure` table: groups in order
+    of first appearance, sources by count, ties broken by first appearance.
+    """
+    if counts.empty:
+        return pd.DataFrame()
+    by_group = counts.groupby("group", sort=False, dropna=False)
+    counts = counts.assign(group_first=by_group["first"].transform("min"), total=by_group["count"].transform("sum"))
+    counts = counts.sort_values(["group_first", "count", "first"], ascending=[True, False, True])
+    rank = counts.groupby("group_first").cumcount().to_numpy() + 1
+    keep = rank <= top_n if top_n is not None else np.ones(len(counts), dtype=bool)
+    if not keep.any():
+        return pd.DataFrame()
+    counts = counts[keep]
+    return pd.DataFrame({
+        "group": counts["group"].to_numpy(),
+        "rank": rank[keep].astype(np.int64),
+        "source": counts["source"].to_numpy(),
+        "count": counts["count"].to_numpy(),
+        "percent": counts["count"].to_numpy() / counts["total"].to_numpy(),
+    })
+
+
+def merge_exposure_counts(parts):
+    """Combine `exposure_counts` of consecutive batches (their `first` already offset)."""
+    if len(parts) == 1:
+        return parts[0]
+    merged = pd.concat(parts, ignore_index=True).groupby(["group", "source"], sort=False, dropna=False)
+    return merged.agg(count=("count", "sum"), first=("first", "min")).reset_index()
+
+
+def merge_group_distributions(parts, group_col, n):
+    """Combine per-batch `group_distribution` tables into the table over all `n` rows."""
+    if len(parts) == 1:
+        return parts[0]
+    merged = pd.concat(parts, ignore_index=True).groupby(group_col, sort=False, dropna=False)["count"].sum()
+    count_df = merged.reset_index()
+    count_df["percent"] = count_df["count"] / n
+    return count_df
+
+
+def scan_summary(cascade_df, group_col="S_modularity", saw_col="sawgu", rates=(), distribution=False,
+                 exposures=False):
+    """
+    Reduce a frame, or a `DiffusionStore` batch by batch, to the additive counts of
+    `CascadeSummary`: the row count 'n', the hits of each requested rate ('in_group',
+    'direct', 'indirect') and, if requested, the merged 'group_distribution' and
+    'exposure_counts' tables.
+    """
+    columns = {"in_group": ["S_modularity", "T_modularity"], "direct": [saw_col], "indirect": [saw_col, "level"]}
+    needed = [col for rate in rates for col in columns[rate]]
+    needed += [group_col] if distribution else []
+    needed += [group_col, saw_col] if exposures else []
+
+    n, hits, distributions, exposure_parts = 0, dict.fromkeys(rates, 0), [], []
+    for batch in iter_frames(cascade_df, list(dict.fromkeys(needed))):
+        summary = CascadeSummary(batch)
+        masks = {
+            "in_group": summary.in_group_mask,
+            "direct": lambda: summary.direct_mask(saw_col),
+            "indirect": lambda: summary.indirect_mask(saw_col),
+        }
+        for rate in rates:
+            hits[rate] += int(masks[rate]().sum())
+        if distribution:
+            distributions.append(summary.group_distribution(group_col))
+        if exposures:
+            part = summary.exposure_counts(group_col, saw_col)
+            part["first"] += n
+            exposure_parts.append(part)
+        n += summary.n
+
+    result = {"n": n, **hits}
+    if distribution:
+        result["group_distribution"] = merge_group_distributions(distributions, group_col, n)
+    if exposures:
+        result["exposure_counts"] = merge_exposure_counts(exposure_parts)
+    return result
+
+
+def summarize_cascades(cascade_df, group_col="S_modularity", saw_col="sawgu", top_n=5):
+    """
+    Compute `count_group_distribution`, the three rates and `groupwise_top_exposure`
+    in one pass over shared categorical codes (batch by batch for a `DiffusionStore`).
+    Returns a dict of the results.
+    """
+    counts = scan_summary(cascade_df, group_col, saw_col, rates=("in_group", "direct", "indirect"),
+                          distribution=True, exposures=True)
+    return {
+        "group_distribution": counts["group_distribution"],
+        "in_group_sharing_rate": counts["in_group"] / counts["n"],
+        "direct_exposure_rate": counts["direct"] / counts["n"],
+        "indirect_exposure_rate": counts["indirect"] / counts["n"],
+        "top_exposure": rank_exposures(counts["exposure_counts"], top_n),
+    }
+
+
+def bootstrap_cascade_summary(cascade_df, group_col="S_modularity", saw_col="sawgu", n_boot=10_000, ci=0.95,
+                              seed=None, cluster_col="nr"):
+    """
+    Cluster bootstrap (by cascade `nr`) of the three rates and `count_group_distribution`.
+    Point estimates equal the plain functions; see `CascadeSummary.bootstrap`.
+    A `DiffusionStore` is loaded for the needed columns, since resampling needs
+    all cascades at once.
+    """
+    cascade_df = as_frame(cascade_df, list(dict.fromkeys([cluster_col, group_col, "S_modularity", "T_modularity",
+                                                          saw_col, "level"])))
+    return CascadeSummary(cascade_df).bootstrap(n_boot, ci, seed, cluster_col, group_col, saw_col)
+
+
 def count_group_distribution(cascade_df, group_col):
     """
     Count number of rows per group in a specified column.
     Returns a DataFrame of proportions.
     """
-    counter = collections.Counter(cascade_df[group_col])
-    count_df = pd.DataFrame.from_dict(counter, orient='index', columns=['count'])
-    count_df["percent"] = count_df["count"] / len(cascade_df)
-    return count_df.reset_index(names=group_col)
+    return scan_summary(cascade_df, group_col, distribution=True)["group_distribution"]
 
 
 def compute_in_group_sharing_rate(cascade_df):
     """
     Compute the percentage of in-group retweets (same modularity between source and target).
     """
-    same_group = cascade_df[cascade_df["S_modularity"] == cascade_df["T_modularity"]]
-    return len(same_group) / len(cascade_df)
+    counts = scan_summary(cascade_df, rates=("in_group",))
+    return counts["in_group"] / counts["n"]
 
 
 def compute_direct_exposure_rate(cascade_df):
     """Percentage of tweets seen without any intermediary (sawgu = 'direct')."""
-    return len(cascade_df[cascade_df["sawgu"] == "direct"]) / len(cascade_df)
+    counts = scan_summary(cascade_df, rates=("direct",))
+    return counts["direct"] / counts["n"]
 
 
 def compute_indirect_exposure_rate(cascade_df):
     """Percentage of users exposed indirectly through intermediaries."""
-    indirect = cascade_df[cascade_df["sawgu"] != "direct"]
-    indirect_via_intermediary = indirect[indirect["level"] == 0]
-    return len(indirect_via_intermediary) / len(cascade_df)
+    counts = scan_summary(cascade_df, rates=("indirect",))
+    return counts["indirect"] / counts["n"]
 
 
 def groupwise_top_exposure(cascade_df, group_col="S_modularity", saw_col="sawgu", top_n=5):
@@ -67,21 +396,5 @@ def groupwise_top_exposure(cascade_df, group_col="S_modularity", saw_col="sawgu"
     For each group, get top N exposure sources (from 'sawgu' column).
     Returns a DataFrame with relative proportions.
     """
-    results = []
-
-    for group in cascade_df[group_col].unique():
-        group_df = cascade_df[cascade_df[group_col] == group]
-        counter = collections.Counter(group_df[saw_col])
-        total = sum(counter.values())
-        top_items = counter.most_common(top_n)
-
-        for i, (source, count) in enumerate(top_items):
-            results.append({
-                "group": group,
-                "rank": i + 1,
-                "source": source,
-                "count": count,
-                "percent": count / total
-            })
-
-    return pd.DataFrame(results)
+    counts = scan_summary(cascade_df, group_col, saw_col, exposures=True)
+    return rank_exposures(counts["exposure_counts"], top_n)
@@ -1,4 +1,18 @@
+import heapq
+import tempfile
 import pandas as pd
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+
+from diffusion_store import DiffusionWriter
+from follow_graph import FollowGraph, NameRanks, write_follow_graph
+from user_index import encode_columns
+
+
+# Prefix representation of a cascade's earlybird lists: row i saw `ref_id` and
+# `users[:i + 1]`, and `positions` maps each user to the positions they retweeted at.
+Earlybirds = namedtuple("Earlybirds", ["users", "ref_id", "positions"])
 
 
 def lower_list(lst):
@@ -22,6 +36,35 @@ def get_earlybird_list(user_list, ref_id):
     return earlybirds
 
 
+def get_earlybird_index(user_list, ref_id):
+    """
+    Create the prefix-based earlybird representation of a cascade.
+    "Seen before me" becomes a comparison of cascade positions, so no
+    per-row prefix lists are allocated.
+    """
+    return Earlybirds(list(user_list), ref_id, get_cascade_positions(user_list))
+
+
+def get_cascade_positions(user_list):
+    """Map each user to the ascending list of positions at which they retweeted."""
+    positions = {}
+    for pos, user in enumerate(user_list):
+        positions.setdefault(user, []).append(pos)
+    return positions
+
+
+def get_rank_map(following):
+    """Map each name of an ordered following list to its ranks in that list."""
+    if following is None:
+        return {}
+    if isinstance(following, dict):
+        return following
+    ranks = {}
+    for rank, name in enumerate(following):
+        ranks.setdefault(name, []).append(rank)
+    return ranks
+
+
 def get_ordered_following(users, following_dict):
     """
     Returns ordered lowercase following list per user, reversed for recency ordering.
@@ -29,20 +72,40 @@ def get_ordered_following(users, following_dict):
     return [lower_list(following_dict.get(user, []))[::-1] for user in users]
 
 
+def get_order_fo(earlybirds, following):
+    """
+    For each user: their following list restricted to the earlybird exposure list.
+    `earlybirds` may be a list of lists or an `Earlybirds` prefix index.
+    """
+    if isinstance(earlybirds, Earlybirds):
+        return [get_order_fo_indexed(i, earlybirds.positions, get_rank_map(f), earlybirds.ref_id)
+                for i, f in enumerate(following)]
+    return [intersection_ordered(f, eb) for f, eb in zip(following, earlybirds)]
+
+
 def get_order_saw(earlybirds, following, ref_id):
     """
     For each user: intersect their following with earlybird exposure list.
     If ref_id appears in list, and was followed later than someone else, trim the list.
+    `earlybirds` may be a list of lists or an `Earlybirds` prefix index.
     """
-    order_po = [intersection_ordered(eb, f) for eb, f in zip(earlybirds, following)]
+    if isinstance(earlybirds, Earlybirds):
+        order_po = [get_order_po_indexed(i, earlybirds.users, earlybirds.positions, get_rank_map(f), ref_id)
+                    for i, f in enumerate(following)]
+    else:
+        order_po = [intersection_ordered(eb, f) for eb, f in zip(earlybirds, following)]
+    return order_po, get_saw_after_ref(order_po, ref_id)
+
+
+def get_saw_after_ref(order_po, ref_id):
+    """Trim each order_po list to what was seen after ref_id, if it appears."""
     order_saw = []
-    for i in range(len(order_po)):
-        saw_list = order_po[i]
+    for saw_list in order_po:
         if ref_id in saw_list:
             sep = saw_list.index(ref_id)
             saw_list = saw_list[sep + 1:]  # only what was seen after ref
         order_saw.append(saw_list)
-    return order_po, order_saw
+    return order_saw
 
 
 def get_last_diff(saw_lists, ref_id):
@@ -50,10 +113,232 @@ def get_last_diff(saw_lists, ref_id):
     return [saw[-1] if saw else ref_id for saw in saw_lists]
 
 
-def build_diffusion_trees(contents_posted, dict_refu, dictAll):
+def build_following_index(following_dict):
+    """
+    Pre-normalize the following graph once for all cascades.
+    Returns a dict mapping user → {lowercase followed user: [ranks]}, where a rank
+    is the position in the reversed (recency-ordered) following list.
+    A memory-mapped `FollowGraph` is already normalized and is wrapped as is.
+    """
+    if isinstance(following_dict, FollowGraph):
+        return NameRanks(following_dict)
+    index = {}
+    for user, following in following_dict.items():
+        index[user] = get_rank_map(lower_list(following)[::-1])
+    return index
+
+
+def get_order_po_indexed(i, user_list, positions, ranks, ref_id):
+    """
+    Ordered intersection of the earlybird list of position i with a user's following,
+    scanning whichever of the two is shorter.
+    """
+    if not ranks:
+        return []
+    order_po = [ref_id] if ref_id in ranks else []
+    if len(ranks) <= i:
+        seen = []
+        for name in ranks:
+            for pos in positions.get(name, ()):
+                if pos > i:
+                    break
+                seen.append(pos)
+        seen.sort()
+        order_po += [user_list[pos] for pos in seen]
+    else:
+        order_po += [user for user in user_list[:i + 1] if user in ranks]
+    return order_po
+
+
+def get_order_fo_indexed(i, positions, ranks, ref_id):
+    """Following list (in recency order) restricted to users seen up to position i."""
+    hits = []
+    for name, name_ranks in ranks.items():
+        if name == ref_id or positions.get(name, [i + 1])[0] <= i:
+            hits.extend((rank, name) for rank in name_ranks)
+    hits.sort()
+    return [name for _, name in hits]
+
+
+def attribute_exposures(user_list, ref_id, following_index):
+    """
+    Compute order_po, order_saw and diff_last for one cascade from a following index
+    built by `build_following_index`, without materializing per-row lists.
+    """
+    earlybirds = get_earlybird_index(user_list, ref_id)
+    following = [following_index.get(user) for user in earlybirds.users]
+    order_po, order_saw = get_order_saw(earlybirds, following, ref_id)
+    return order_po, order_saw, get_last_diff(order_po, ref_id)
+
+
+def init_cascade_state(content_id, nr, ref_id, users=(), targets=(), saw=()):
+    """
+    Persistable (picklable) state of one cascade: its ordered users, their positions
+    and the exposure results (Target / saw) computed so far.
+    """
+    users = list(users)
+    return {
+        "content": content_id,
+        "nr": nr,
+        "ref_id": ref_id,
+        "users": users,
+        "positions": get_cascade_positions(users),
+        "targets": list(targets),
+        "saw": list(saw),
+    }
+
+
+def cascade_states_from_diffusion(diffusion_df, dict_refu):
+    """Rebuild the state of every cascade (keyed by nr) from a `build_diffusion_trees` result."""
+    states = {}
+    for nr, group in diffusion_df.groupby("nr", sort=False):
+        content_id = group["ref"].iloc[0]
+        states[nr] = init_cascade_state(content_id, nr, dict_refu[content_id][0], group["Source"].tolist(),
+                                        group["Target"].tolist(), group["saw"].tolist())
+    return states
+
+
+def extend_cascade(state, users, timestamps, retweet_ids, following_index):
+    """
+    Append new retweeters to a cascade state in time order.
+    Only the new rows are computed, since a row depends only on the users before it.
+    Returns the new rows in the `build_diffusion_trees` format and updates `state`.
+    """
+    order = sorted(range(len(users)), key=lambda k: timestamps[k])
+    ref_id = state["ref_id"]
+    sources, targets, saw_lists = [], [], []
+    for k in order:
+        user = users[k]
+        i = len(state["users"])
+        state["users"].append(user)
+        state["positions"].setdefault(user, []).append(i)
+
+        ranks = get_rank_map(following_index.get(user))
+        po = get_order_po_indexed(i, state["users"], state["positions"], ranks, ref_id)
+        saw = po[1:] if ref_id in ranks else po
+        target = get_last_diff([po], ref_id)[0]
+
+        state["targets"].append(target)
+        state["saw"].append(saw)
+        sources.append(user)
+        targets.append(target)
+        saw_lists.append(saw)
+
+    return pd.DataFrame({
+        "Source": sources,
+        "Target": targets,
+        "time": [timestamps[k] for k in order],
+        "ref": [state["content"]] * len(order),
+        "nr": [state["nr"]] * len(order),
+        "retweet": [retweet_ids[k] for k in order],
+        "saw": saw_lists
+    })
+
+
+def shard_by_size(sizes, n_shards):
+    """
+    Assign items to at most n_shards shards, largest first, each to the currently
+    lightest shard. Returns lists of item positions, each in ascending order.
+    """
+    loads = [(0, s) for s in range(n_shards)]
+    shards = [[] for _ in range(n_shards)]
+    for k in sorted(range(len(sizes)), key=lambda k: -sizes[k]):
+        load, s = heapq.heappop(loads)
+        shards[s].append(k)
+        heapq.heappush(loads, (load + sizes[k], s))
+    return [sorted(shard) for shard in shards if shard]
+
+
+_worker_following = None
+
+
+def _init_worker(graph_dir, cache_size):
+    """
+    Open the memory-mapped following graph once per worker process. The following
+    sets of the `cache_size` most recently used users are kept decoded, since a user
+    is looked up on every row of every cascade they take part in.
+    """
+    global _worker_following
+    _worker_following = lru_cache(maxsize=cache_size)(FollowGraph(graph_dir).following_set)
+
+
+def _attribute_shard(shard):
+    """
+    Worker: compute (position, order_saw, diff_last) for encoded cascades.
+    Only membership in a user's following matters here, so it is tested on the
+    cached code sets instead of decoding rank maps.
+    """
+    results = []
+    for k, user_codes, ref_code in shard:
+        positions = get_cascade_positions(user_codes)
+        order_po = [get_order_po_indexed(i, user_codes, positions, _worker_following(code), ref_code)
+                    for i, code in enumerate(user_codes)]
+        results.append((k, get_saw_after_ref(order_po, ref_code), get_last_diff(order_po, ref_code)))
+    return results
+
+
+def build_exposures_parallel(contents_posted, dict_refu, dictAll, workers, graph_dir=None, cache_size=1 << 14):
+    """
+    Compute (order_saw, diff_last) for every cascade on a process pool.
+
+    The following graph is written once as a memory-mapped CSR (see `follow_graph`)
+    that all workers share; cascades travel to the workers as integer codes, are
+    sharded by size and come back in the order of `contents_posted`. Each worker
+    keeps the following sets of up to `cache_size` users decoded.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        if graph_dir is None:
+            graph_dir = dictAll.path if isinstance(dictAll, FollowGraph) else write_follow_graph(dictAll, tmp)
+        names = list(FollowGraph(graph_dir).names)
+        codes = {name: code for code, name in enumerate(names)}
+
+        def encode(name):
+            if name not in codes:
+                codes[name] = len(names)
+                names.append(name)
+            return codes[name]
+
+        cascades = []
+        for k, (content_id, users) in enumerate(zip(contents_posted["contents"], contents_posted["users"])):
+            ref_code = encode(dict_refu[content_id][0])
+            cascades.append((k, [encode(user) for user in users], ref_code))
+
+        shards = shard_by_size([len(c[1]) for c in cascades], workers * 4)
+        exposures = [None] * len(cascades)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(str(graph_dir), cache_size)) as executor:
+            futures = [executor.submit(_attribute_shard, [cascades[k] for k in shard]) for shard in shards]
+            for done, future in enumerate(as_completed(futures), 1):
+                for k, order_saw, diff_last in future.result():
+                    exposures[k] = ([[names[c] for c in saw] for saw in order_saw],
+                                    [names[c] for c in diff_last])
+                print(f"Processed shard {done}/{len(shards)}")
+
+    return exposures
+
+
+def build_diffusion_trees(contents_posted, dict_refu, dictAll, following_index=None, workers=1, graph_dir=None,
+                          output_dir=None, batch_rows=500_000, user_index=None):
     """
     Build exposure trees for each original tweet.
+    A prebuilt `following_index` (see `build_following_index`) can be passed
+    to reuse the normalized following graph across calls.
+    With workers > 1, cascades are processed on a process pool sharing a
+    memory-mapped copy of the graph (`graph_dir`, written to a temporary
+    directory if not given); the result is identical to the serial run.
+    With `output_dir`, completed cascades are streamed to Parquet partitions of
+    about `batch_rows` rows and a lazy `DiffusionStore` is returned instead
+    of a DataFrame.
+    With a `UserIndex`, Source and Target are returned (or written) as int32 codes
+    of that shared index.
     """
+    exposures = None
+    if workers > 1:
+        exposures = build_exposures_parallel(contents_posted, dict_refu, dictAll, workers, graph_dir)
+    elif following_index is None:
+        following_index = build_following_index(dictAll)
+
+    writer = DiffusionWriter(output_dir, batch_rows, user_index) if output_dir is not None else None
     all_sources = []
     all_targets = []
     all_refs = []
@@ -62,36 +347,34 @@ def build_diffusion_trees(contents_posted, dict_refu, dictAll):
     all_retweet_ids = []
     all_saw_lists = []
 
-    for i, row in contents_posted.iterrows():
+    for k, (i, row) in enumerate(contents_posted.iterrows()):
         content_id = row["contents"]
         users = row["users"]
         timestamps = row["time"]
         retweet_ids = row["retweets"]
         ref_user = dict_refu[content_id][0]
 
-        df = pd.DataFrame({
-            "user": users,
-        })
-
-        df["content"] = content_id
-        df["following"] = get_ordered_following(users, dictAll)
+        if exposures is not None:
+            order_saw, diff_last = exposures[k]
+        else:
+            _, order_saw, diff_last = attribute_exposures(users, ref_user, following_index)
+            print(f"Processed cascade {i}/{len(contents_posted)}")
 
-        df["earlybird"] = get_earlybird_list(users, ref_user)
-        df["order_fo"] = [intersection_ordered(f, e) for f, e in zip(df["following"], df["earlybird"])]
-        order_po, order_saw = get_order_saw(df["earlybird"], df["following"], ref_user)
-        df["order_po"] = order_po
-        df["order_saw"] = order_saw
-        df["diff_last"] = get_last_diff(order_po, ref_user)
+        if writer is not None:
+            writer.append(Source=list(users), Target=diff_last, time=list(timestamps), ref=[content_id] * len(users),
+                          nr=[i] * len(users), retweet=list(retweet_ids), saw=order_saw)
+            continue
 
-        all_sources += df["user"].tolist()
-        all_targets += df["diff_last"].tolist()
-        all_refs += [content_id] * len(df)
-        all_post_ids += [i] * len(df)
+        all_sources += list(users)
+        all_targets += diff_last
+        all_refs += [content_id] * len(users)
+        all_post_ids += [i] * len(users)
         all_times += timestamps
         all_retweet_ids += retweet_ids
-        all_saw_lists += df["order_saw"].tolist()
+        all_saw_lists += order_saw
 
-        print(f"Processed cascade {i}/{len(contents_posted)}")
+    if writer is not None:
+        return writer.close()
 
     diffusion_df = pd.DataFrame({
         "Source": all_sources,
@@ -103,4 +386,6 @@ def build_diffusion_trees(contents_posted, dict_refu, dictAll):
         "saw": all_saw_lists
     })
 
+    if user_index is not None:
+        diffusion_df = encode_columns(diffusion_df, user_index, ["Source", "Target"])
     return diffusion_df
@@ -1,7 +1,14 @@
+import argparse
+import os
+import numpy as np
 import pandas as pd
 import networkx as nx
 import collections
+from scipy import sparse
+from scipy.sparse import csgraph
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+from statistics import NormalDist
 
 # File paths
 BASE = Path("/Users/xixuan/Desktop/twitter_test/fff_api_alltweets")
@@ -10,29 +17,20 @@ TWEET_FILE = BASE / "tweet_df_ordered_real.csv"
 LABEL_FILE = BASE / "tweet_df_classified14.csv"
 OUTPUT_FILE = BASE / "network_metrics.csv"
 
-# Load data
-edges = pd.read_csv(EDGE_FILE, encoding="utf-8")
-tweets = pd.read_csv(TWEET_FILE, encoding="utf-8")
+# Non-tree cascades with more users than this get a sampled virality estimate
+APPROX_THRESHOLD = 20_000
+APPROX_SOURCES = 256
 
-# Map ref to refu (original tweet)
-ref_map = tweets.groupby("ref")["refu"].first().to_dict()
-edges["refu"] = edges["ref"].map(ref_map)
-edges = edges.sort_values("nr").reset_index(drop=True)
-
-# Initialize results
-records = []
-
-# Process one cascade (network) per unique 'nr'
-for nr, group in edges.groupby("nr"):
-    ref_user = group["refu"].iloc[0]
-    users = pd.unique(group[["Source", "Target"]].values.ravel())
-    user_count = len(users)
 
+def undirected_graph(group, users):
+    """Undirected networkx graph of one cascade."""
     G = nx.from_pandas_edgelist(group, "Source", "Target", create_using=nx.DiGraph())
     G.add_nodes_from(users)
-    UG = G.to_undirected()
+    return G.to_undirected()
 
-    # Depth: longest shortest-path from the root (if reachable)
+
+def root_metrics(UG, ref_user):
+    """Depth: longest shortest-path from the root (if reachable); breadth: largest BFS level."""
     try:
         bfs_lengths = nx.single_source_shortest_path_length(UG, ref_user)
         depth = max(bfs_lengths.values())
@@ -40,6 +38,14 @@ for nr, group in edges.groupby("nr"):
     except Exception:
         depth = 0
         breadth = 0
+    return depth, breadth
+
+
+def exact_metrics(group, users, ref_user):
+    """Depth, max breadth and virality by BFS from the root and from every node."""
+    user_count = len(users)
+    UG = undirected_graph(group, users)
+    depth, breadth = root_metrics(UG, ref_user)
 
     # Virality: average pairwise shortest path
     try:
@@ -48,17 +54,362 @@ for nr, group in edges.groupby("nr"):
     except Exception:
         virality = 0
 
-    records.append({
+    return depth, breadth, virality
+
+
+def tree_metrics(group, users, ref_user):
+    """
+    Depth, max breadth and virality in O(n) for cascades whose undirected graph is
+    a forest: the Wiener index is the sum over edges of size * (component - size)
+    of the subtree below the edge. Returns None for other inputs.
+    """
+    if pd.isna(users).any():
+        return None
+
+    adj = {u: [] for u in users}
+    edges = set()
+    for s, t in zip(group["Source"], group["Target"]):
+        edge = frozenset((s, t))
+        if s != t and edge not in edges:
+            edges.add(edge)
+            adj[s].append(t)
+            adj[t].append(s)
+
+    user_count = len(users)
+    if len(edges) >= user_count:
+        return None
+
+    parent = {}
+    depth = breadth = 0
+    total_dist = 0
+    components = 0
+    for start in ([ref_user] if ref_user in adj else []) + list(adj):
+        if start in parent:
+            continue
+        components += 1
+        parent[start] = None
+        order, level = [start], {start: 0}
+        for u in order:
+            for v in adj[u]:
+                if v not in parent:
+                    parent[v] = u
+                    level[v] = level[u] + 1
+                    order.append(v)
+
+        if start == ref_user:
+            depth = max(level.values())
+            breadth = max(collections.Counter(level.values()).values())
+
+        size = dict.fromkeys(order, 1)
+        for u in reversed(order[1:]):
+            size[parent[u]] += size[u]
+            total_dist += size[u] * (len(order) - size[u])
+
+    if len(edges) != user_count - components:
+        return None
+
+    # Each unordered pair is counted in both directions, as in exact_metrics
+    virality = 2 * total_dist / (user_count * (user_count - 1)) if user_count > 1 else 0
+    return depth, breadth, virality
+
+
+def sampled_metrics(group, users, ref_user, k=APPROX_SOURCES, seed=None, confidence=0.95):
+    """
+    Depth, max breadth and a virality estimate from BFS runs out of k sampled sources.
+
+    Virality is the mean over sources of (sum of distances) / (n - 1), so the sample
+    mean is unbiased; the interval is a normal one with finite-population correction.
+    Returns (depth, breadth, virality, low, high).
+    """
+    user_count = len(users)
+    UG = undirected_graph(group, users)
+    depth, breadth = root_metrics(UG, ref_user)
+
+    k = min(k, user_count)
+    sources = np.random.default_rng(seed).choice(user_count, size=k, replace=False)
+    sums = np.array([sum(nx.single_source_shortest_path_length(UG, users[i]).values()) for i in sources], dtype=float)
+    virality = sums.mean() / (user_count - 1)
+    se = 0.0
+    if 1 < k < user_count:
+        se = sums.std(ddof=1) / np.sqrt(k) * np.sqrt((user_count - k) / (user_count - 1)) / (user_count - 1)
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    return depth, breadth, virality, virality - z * se, virality + z * se
+
+
+def cascade_metrics(group, users, ref_user, approx_threshold=APPROX_THRESHOLD, approx_sources=APPROX_SOURCES,
+                    seed=None):
+    """
+    Tree fast path with fallback to the exact BFS computation, or to the sampled
+    estimate for non-tree cascades above `approx_threshold` users (None disables it).
+    Returns (depth, breadth, virality, method, virality_low, virality_high).
+    """
+    metrics = tree_metrics(group, users, ref_user)
+    if metrics is not None:
+        return (*metrics, "tree", metrics[2], metrics[2])
+    if approx_threshold is not None and len(users) > approx_threshold:
+        depth, breadth, virality, low, high = sampled_metrics(group, users, ref_user, approx_sources, seed)
+        return depth, breadth, virality, "sampled", low, high
+    depth, breadth, virality = exact_metrics(group, users, ref_user)
+    return depth, breadth, virality, "exact", virality, virality
+
+
+def prepare_edges(edges, tweets):
+    """Attach the original poster (refu) to every edge and sort by cascade."""
+    ref_map = tweets.groupby("ref")["refu"].first().to_dict()
+    edges = edges.copy()
+    edges["refu"] = edges["ref"].map(ref_map)
+    return edges.sort_values("nr").reset_index(drop=True)
+
+
+def metrics_record(nr, group, approx_threshold=APPROX_THRESHOLD, approx_sources=APPROX_SOURCES, seed=0):
+    """Network metrics of one cascade (network) as an output row."""
+    ref_user = group["refu"].iloc[0]
+    users = pd.unique(group[["Source", "Target"]].values.ravel())
+    # Seeding per cascade keeps sampled estimates independent of chunking
+    depth, breadth, virality, method, low, high = cascade_metrics(group, users, ref_user, approx_threshold,
+                                                                  approx_sources, [seed, int(nr)])
+
+    return {
         "Origin": ref_user,
         "nr": nr,
         "contents": group["ref"].iloc[0],
-        "size": user_count,
+        "size": len(users),
         "depth": depth,
         "max_breadth": breadth,
-        "virality": virality
+        "virality": virality,
+        "virality_method": method,
+        "virality_low": low,
+        "virality_high": high
+    }
+
+
+def metrics_chunk(groups, backend="networkx", approx=None):
+    """Worker: metrics for a list of (nr, group) cascades."""
+    approx = approx or {}
+    if backend == "csgraph":
+        if not groups:
+            return []
+        edges = pd.concat([group for _, group in groups]).sort_values("nr", kind="stable")
+        return batched_metrics(edges, **approx).to_dict("records")
+    return [metrics_record(nr, group, **approx) for nr, group in groups]
+
+
+def size_balanced_chunks(groups, chunk_edges):
+    """Pack (nr, group) cascades, largest first, into chunks of about chunk_edges edges."""
+    chunks, chunk, size = [], [], 0
+    for nr, group in sorted(groups, key=lambda g: -len(g[1])):
+        chunk.append((nr, group))
+        size += len(group)
+        if size >= chunk_edges:
+            chunks.append(chunk)
+            chunk, size = [], 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def batched_metrics(edges, approx_threshold=APPROX_THRESHOLD, approx_sources=APPROX_SOURCES, seed=0):
+    """
+    Metrics for all cascades of a `prepare_edges` frame with scipy.sparse.csgraph.
+
+    All cascades become one block-diagonal graph over (nr, user) node codes plus a
+    virtual super-root linked to each cascade's root and to one node of every
+    other component. A single BFS from the super-root gives root distances
+    (depth, level histogram = breadth) and a spanning forest whose subtree sizes
+    give the Wiener index of forest-shaped cascades; sizes and component counts
+    come from NumPy group reductions. Cascades with NA users, and the virality of
+    cascades containing a cycle, fall back to the per-cascade computation.
+    """
+    approx = {"approx_threshold": approx_threshold, "approx_sources": approx_sources, "seed": seed}
+    na_nr = edges.loc[edges["Source"].isna() | edges["Target"].isna(), "nr"].unique()
+    records = [metrics_record(nr, group, **approx) for nr, group in edges[edges["nr"].isin(na_nr)].groupby("nr")]
+    edges = edges[~edges["nr"].isin(na_nr)]
+    if edges.empty:
+        return pd.DataFrame(records)
+
+    first = edges.drop_duplicates(subset=["nr"])
+    nrs = first["nr"].to_numpy()
+    n_cascades = len(nrs)
+    n_edges = len(edges)
+    edge_cascade = np.searchsorted(nrs, edges["nr"].to_numpy())
+
+    # Node codes for (cascade, user) pairs
+    user_codes, user_names = pd.factorize(np.concatenate([edges["Source"].to_numpy(), edges["Target"].to_numpy(),
+                                                          first["refu"].to_numpy()]), use_na_sentinel=False)
+    n_users = len(user_names)
+    keys = np.concatenate([edge_cascade, edge_cascade]).astype(np.int64) * n_users + user_codes[:2 * n_edges]
+    node_keys, inverse = np.unique(keys, return_inverse=True)
+    src, dst = inverse[:n_edges], inverse[n_edges:]
+    n_nodes = len(node_keys)
+    node_cascade = node_keys // n_users
+    size = np.bincount(node_cascade, minlength=n_cascades)
+
+    # Root node per cascade (only where the root user is part of the cascade)
+    root_keys = np.arange(n_cascades, dtype=np.int64) * n_users + user_codes[2 * n_edges:]
+    root_node = np.searchsorted(node_keys, root_keys).clip(max=n_nodes - 1)
+    has_root = node_keys[root_node] == root_keys
+
+    # Components, distinct undirected edges and the forest test per cascade
+    graph = sparse.coo_matrix((np.ones(n_edges), (src, dst)), shape=(n_nodes, n_nodes)).tocsr()
+    n_components, labels = csgraph.connected_components(graph, directed=False)
+    comp_size = np.bincount(labels)
+    comp_cascade = np.zeros(n_components, dtype=np.int64)
+    comp_cascade[labels] = node_cascade
+    lo, hi = np.minimum(src, dst), np.maximum(src, dst)
+    undirected = np.unique(lo[lo != hi].astype(np.int64) * n_nodes + hi[lo != hi])
+    edge_count = np.bincount(node_cascade[undirected // n_nodes], minlength=n_cascades)
+    is_forest = edge_count == size - np.bincount(comp_cascade, minlength=n_cascades)
+
+    # BFS from a super-root linked to the root, or else the first node, of every component
+    rep = np.empty(n_components, dtype=np.int64)
+    rep[labels[::-1]] = np.arange(n_nodes)[::-1]
+    rep[labels[root_node[has_root]]] = root_node[has_root]
+    super_root = n_nodes
+    bfs_graph = sparse.coo_matrix(
+        (np.ones(n_edges + n_components),
+         (np.concatenate([src, np.full(n_components, super_root)]), np.concatenate([dst, rep]))),
+        shape=(n_nodes + 1, n_nodes + 1)).tocsr()
+    dist, pred = csgraph.shortest_path(bfs_graph, directed=False, unweighted=True, indices=super_root,
+                                       return_predecessors=True)
+    level = dist[:n_nodes].astype(np.int64) - 1
+    pred = pred[:n_nodes]
+
+    # Depth and breadth from the BFS levels of the root's component
+    in_root_comp = has_root[node_cascade] & (labels == labels[root_node[node_cascade]])
+    depth = np.zeros(n_cascades, dtype=np.int64)
+    breadth = np.zeros(n_cascades, dtype=np.int64)
+    np.maximum.at(depth, node_cascade[in_root_comp], level[in_root_comp])
+    level_keys, level_counts = np.unique(node_cascade[in_root_comp] * (level.max() + 1) + level[in_root_comp],
+                                         return_counts=True)
+    np.maximum.at(breadth, level_keys // (level.max() + 1), level_counts)
+
+    # Subtree sizes, accumulated level by level from the deepest nodes up
+    subtree = np.ones(n_nodes, dtype=np.int64)
+    by_level = np.argsort(level, kind='stable')
+    bounds = np.searchsorted(level[by_level], np.arange(level.max() + 2))
+    for lvl in range(level.max(), 0, -1):
+        nodes = by_level[bounds[lvl]:bounds[lvl + 1]]
+        np.add.at(subtree, pred[nodes], subtree[nodes])
+    child = level > 0
+    total_dist = np.zeros(n_cascades, dtype=np.int64)
+    np.add.at(total_dist, node_cascade[child], subtree[child] * (comp_size[labels[child]] - subtree[child]))
+
+    pairs = size * (size - 1)
+    virality = np.divide(2 * total_dist, pairs, out=np.zeros(n_cascades), where=pairs > 0)
+    method = np.full(n_cascades, "tree", dtype=object)
+    low, high = virality.copy(), virality.copy()
+
+    groups = edges[edges["nr"].isin(nrs[~is_forest])].groupby("nr")
+    for nr, group in groups:
+        k = np.searchsorted(nrs, nr)
+        users = pd.unique(group[["Source", "Target"]].values.ravel())
+        _, _, virality[k], method[k], low[k], high[k] = cascade_metrics(
+            group, users, group["refu"].iloc[0], approx_threshold, approx_sources, [seed, int(nr)])
+
+    metrics_df = pd.DataFrame({
+        "Origin": first["refu"].to_numpy(),
+        "nr": nrs,
+        "contents": first["ref"].to_numpy(),
+        "size": size,
+        "depth": depth,
+        "max_breadth": breadth,
+        "virality": virality,
+        "virality_method": method,
+        "virality_low": low,
+        "virality_high": high
     })
+    return pd.concat([metrics_df, pd.DataFrame(records)], ignore_index=True).sort_values("nr").reset_index(drop=True)
+
+
+def load_finished(output_file):
+    """Rows of a previous (possibly interrupted) run; a partially written last line is cut off."""
+    if output_file is None or not Path(output_file).exists():
+        return pd.DataFrame()
+    with open(output_file, 'rb+') as f:
+        content = f.read()
+        f.truncate(content.rfind(b'\n') + 1)
+    if Path(output_file).stat().st_size == 0:
+        Path(output_file).unlink()
+        return pd.DataFrame()
+    return pd.read_csv(output_file, sep=";", encoding="utf-8")
+
+
+def compute_cascade_metrics(edges, tweets, workers=1, output_file=None, resume=True, chunk_edges=100_000,
+                            backend="networkx", approx_threshold=APPROX_THRESHOLD, approx_sources=APPROX_SOURCES,
+                            seed=0):
+    """
+    Compute size, depth, max breadth and virality for every cascade ('nr').
+
+    Cascades are packed into size-balanced chunks and processed on a pool of
+    `workers` processes. Each finished chunk is appended to `output_file`
+    (';'-separated), so with `resume` an interrupted run skips the cascades
+    already written. Returns all metrics sorted by nr; the output file is
+    rewritten in that order at the end.
+    backend="csgraph" computes each chunk with `batched_metrics` instead of one
+    networkx graph per cascade.
+    Non-tree cascades above `approx_threshold` users get a virality estimate from
+    `approx_sources` sampled BFS sources (see `sampled_metrics`); the method used
+    and the confidence bounds are in virality_method / virality_low / virality_high.
+    """
+    approx = {"approx_threshold": approx_threshold, "approx_sources": approx_sources, "seed": seed}
+    edges = prepare_edges(edges, tweets)
+    done = load_finished(output_file) if resume else pd.DataFrame()
+    if not resume and output_file is not None and Path(output_file).exists():
+        Path(output_file).unlink()
+    finished = set(done["nr"]) if len(done) else set()
+
+    groups = [(nr, group) for nr, group in edges.groupby("nr") if nr not in finished]
+    chunks = size_balanced_chunks(groups, chunk_edges)
+    print(f"{len(finished)} cascades already done, {len(groups)} in {len(chunks)} chunks to go")
+
+    records = []
+
+    def collect(chunk_records, done_chunks):
+        records.extend(chunk_records)
+        if output_file is not None:
+            write_header = not Path(output_file).exists()
+            pd.DataFrame(chunk_records).to_csv(output_file, sep=";", index=False, mode='a', header=write_header)
+        print(f"Finished chunk {done_chunks}/{len(chunks)}")
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(metrics_chunk, chunk, backend, approx) for chunk in chunks]
+            for done_chunks, future in enumerate(as_completed(futures), 1):
+                collect(future.result(), done_chunks)
+    else:
+        for done_chunks, chunk in enumerate(chunks, 1):
+            collect(metrics_chunk(chunk, backend, approx), done_chunks)
+
+    metrics_df = pd.concat([done, pd.DataFrame(records)], ignore_index=True)
+    if len(metrics_df):
+        metrics_df = metrics_df.sort_values("nr").reset_index(drop=True)
+    if output_file is not None:
+        metrics_df.to_csv(output_file, sep=";", index=False)
+    return metrics_df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute network metrics for diffusion cascades.")
+    parser.add_argument("--edges", type=Path, default=EDGE_FILE)
+    parser.add_argument("--tweets", type=Path, default=TWEET_FILE)
+    parser.add_argument("--output", type=Path, default=OUTPUT_FILE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--no-resume", action="store_true", help="Recompute all cascades")
+    parser.add_argument("--backend", choices=["networkx", "csgraph"], default="networkx")
+    parser.add_argument("--approx-threshold", type=int, default=APPROX_THRESHOLD,
+                        help="Sample virality for non-tree cascades above this size (0 disables)")
+    parser.add_argument("--approx-sources", type=int, default=APPROX_SOURCES)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    edges = pd.read_csv(args.edges, encoding="utf-8")
+    tweets = pd.read_csv(args.tweets, encoding="utf-8")
+    compute_cascade_metrics(edges, tweets, workers=args.workers, output_file=args.output,
+                            resume=not args.no_resume, backend=args.backend,
+                            approx_threshold=args.approx_threshold or None, approx_sources=args.approx_sources,
+                            seed=args.seed)
+    print(f"Saved network metrics to: {args.output}")
+
 
-# Store metrics
-metrics_df = pd.DataFrame(records)
-metrics_df.to_csv(OUTPUT_FILE, sep=";", index=False)
-print(f"Saved network metrics to: {OUTPUT_FILE}")
+if __name__ == "__main__":
+    main()
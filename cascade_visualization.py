@@ -1,40 +1,104 @@
+import hashlib
+import json
 import matplotlib.pyplot as plt
 import seaborn as sns
 import pandas as pd
 import numpy as np
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 from matplotlib.dates import DateFormatter
 from matplotlib.ticker import LogLocator
 from mpl_toolkits.axes_grid1.inset_locator import zoomed_inset_axes, mark_inset
 
 
-def plot_ccdf(df, var, group_col, top_labels=None, save_path=None, loglog=True):
+class CCDFHistogram:
+    """
+    Per-group value counts of `var` (rows: values or log-bin lower edges, columns:
+    groups). Histograms of partitions can be computed separately and combined
+    with `+` before computing the CCDF.
+    """
+
+    def __init__(self, counts, var, group_col, log_bins=None):
+        self.counts = counts
+        self.var = var
+        self.group_col = group_col
+        self.log_bins = log_bins
+
+    def __add__(self, other):
+        if (self.var, self.group_col, self.log_bins) != (other.var, other.group_col, other.log_bins):
+            raise ValueError("Cannot merge histograms of different variables, groups or binning")
+        counts = self.counts.add(other.counts, fill_value=0).fillna(0).astype(np.int64)
+        return CCDFHistogram(counts, self.var, self.group_col, self.log_bins)
+
+    def __radd__(self, other):
+        # Allows sum(histograms)
+        return self if other == 0 else self.__add__(other)
+
+    @property
+    def groups(self):
+        return list(self.counts.columns)
+
+    def ccdf(self):
+        """DataFrame with `var` and one column per group holding P(X > value)."""
+        stats = self.counts.astype(float)
+        for col in stats.columns:
+            stats[col] = stats[col] / stats[col].sum()
+            stats[col] = 1 - stats[col].cumsum()
+        return stats.reset_index()
+
+
+def log_bin_edges(values, bins_per_decade):
+    """Lower edge of the logarithmic bin of each value; values <= 0 are kept as they are."""
+    values = np.asarray(values, dtype=float)
+    edges = values.copy()
+    positive = values > 0
+    exponent = np.floor(np.log10(values[positive]) * bins_per_decade + 1e-9) / bins_per_decade
+    edges[positive] = 10 ** exponent
+    return edges
+
+
+def ccdf_histogram(df, var, group_col, log_bins=None):
+    """
+    Count `var` values per group with one `np.unique` / `np.bincount` pass on integer
+    codes. With `log_bins` (bins per decade), positive values are grouped into
+    logarithmic bins labelled by their lower edge. Rows with a missing value or
+    group are ignored.
+    """
+    values = df[var].to_numpy()
+    groups, group_values = pd.factorize(df[group_col], sort=True)
+    valid = (groups >= 0) & pd.notna(values)
+    values, groups = values[valid], groups[valid]
+    if log_bins:
+        values = log_bin_edges(values, log_bins)
+
+    uniques, value_codes = np.unique(values, return_inverse=True)
+    counts = np.bincount(value_codes * len(group_values) + groups, minlength=len(uniques) * len(group_values))
+    counts = pd.DataFrame(counts.reshape(len(uniques), len(group_values)),
+                          index=pd.Index(uniques, name=var), columns=pd.Index(group_values, name='value'))
+    return CCDFHistogram(counts.loc[:, counts.sum(axis=0) > 0], var, group_col, log_bins)
+
+
+def plot_ccdf(df, var, group_col, top_labels=None, save_path=None, loglog=True, show=True):
     """
     Plot CCDF of a variable grouped by a community or topic.
 
     Parameters:
-        df (pd.DataFrame): input data
+        df (pd.DataFrame | CCDFHistogram): input data, or a (merged) histogram
+            from `ccdf_histogram`
         var (str): column to plot
         group_col (str): grouping column (e.g., 'S_modularity', 'label')
         top_labels (list): optional subset of groups to plot
         save_path (str): optional path to save plot
         loglog (bool): log-log axis scaling
+        show (bool): call plt.show() (False for batch rendering)
     """
-    labels = sorted(df[group_col].dropna().unique())
+    hist = df if isinstance(df, CCDFHistogram) else ccdf_histogram(df, var, group_col)
+    labels = hist.groups
     if top_labels:
         labels = [label for label in labels if label in top_labels]
 
-    stats = (df
-             .melt(id_vars=var, value_vars=[group_col])
-             .groupby([var, 'value'])
-             .size()
-             .unstack(fill_value=0))
-
-    # Normalize, compute CDF and CCDF
-    for col in stats.columns:
-        stats[col] = stats[col] / stats[col].sum()
-        stats[col] = 1 - stats[col].cumsum()
-
-    stats = stats.reset_index()
+    stats = hist.ccdf()
 
     # Trim based on signal threshold
     min_vals = stats[labels].min(axis=1)
@@ -56,10 +120,53 @@ def plot_ccdf(df, var, group_col, top_labels=None, save_path=None, loglog=True):
 
     if save_path:
         plt.savefig(save_path, dpi=300, bbox_inches='tight')
-    plt.show()
+    if show:
+        plt.show()
+
 
+def sliding_window_counts(df, time_col, label_col, window_days=7, step_days=1):
+    """
+    Count rows per label in sliding windows [start, start + window) that advance by
+    `step_days` from the first timestamp, while start + window <= last timestamp.
+
+    Rows are binned once by label and by time in units of gcd(window, step); each
+    window is then a difference of cumulative bin counts, so cost does not grow with
+    the window width.
 
-def plot_sliding_window(df, time_col, label_col, window_days=7, step_days=1, save_path=None):
+    Returns:
+        pd.DataFrame: window x label counts (same as a crosstab of the rows copied
+        into every window covering them; empty windows and labels are omitted).
+    """
+    times = pd.to_datetime(df[time_col]).to_numpy(dtype="datetime64[ns]").view(np.int64)
+    valid = times != np.iinfo(np.int64).min  # NaT
+    codes, labels = pd.factorize(df[label_col], sort=True)
+
+    window = pd.Timedelta(days=window_days).value
+    step = pd.Timedelta(days=step_days).value
+    empty = pd.DataFrame(index=pd.Index([], name='window', dtype=np.int64),
+                         columns=pd.Index([], name=label_col), dtype=np.int64)
+    if not valid.any() or times[valid].max() - times[valid].min() < window:
+        return empty
+    start, stop = times[valid].min(), times[valid].max()
+    valid &= codes >= 0
+    n_windows = (stop - start - window) // step + 1
+
+    unit = np.gcd(window, step)
+    n_bins = ((n_windows - 1) * step + window) // unit
+    bins = (times - start) // unit
+    valid &= bins < n_bins
+    counts = np.bincount(bins[valid] * len(labels) + codes[valid], minlength=n_bins * len(labels))
+    cumulative = np.zeros((n_bins + 1, len(labels)), dtype=np.int64)
+    np.cumsum(counts.reshape(n_bins, len(labels)), axis=0, out=cumulative[1:])
+
+    lo = np.arange(n_windows) * (step // unit)
+    windowed = cumulative[lo + window // unit] - cumulative[lo]
+    dft = pd.DataFrame(windowed, index=pd.Index(np.arange(n_windows), name='window'),
+                       columns=pd.Index(labels, name=label_col))
+    return dft.loc[dft.sum(axis=1) > 0, dft.sum(axis=0) > 0]
+
+
+def plot_sliding_window(df, time_col, label_col, window_days=7, step_days=1, save_path=None, show=True):
     """
     Plot timeline of retweet counts per label in sliding windows.
 
@@ -67,26 +174,9 @@ def plot_sliding_window(df, time_col, label_col, window_days=7, step_days=1, sav
         df (DataFrame): must contain datetime column and label column
         time_col (str): name of time column
         label_col (str): label (e.g., topic) column
+        show (bool): call plt.show() (False for batch rendering)
     """
-    df = df.copy()
-    df[time_col] = pd.to_datetime(df[time_col])
-    df = df.sort_values(by=time_col)
-
-    start = df[time_col].min()
-    stop = df[time_col].max()
-
-    times, labels = [], []
-    i = 0
-    while start + pd.Timedelta(days=window_days) <= stop:
-        end = start + pd.Timedelta(days=window_days)
-        temp = df[(df[time_col] >= start) & (df[time_col] < end)]
-        times.extend([i] * len(temp))
-        labels.extend(temp[label_col])
-        start += pd.Timedelta(days=step_days)
-        i += 1
-
-    df_slide = pd.DataFrame({label_col: labels, 'window': times})
-    dft = pd.crosstab(df_slide['window'], df_slide[label_col])
+    dft = sliding_window_counts(df, time_col, label_col, window_days, step_days)
 
     ax = dft.plot(figsize=(12, 6))
     ax.set_xlabel("Sliding time window")
@@ -95,10 +185,58 @@ def plot_sliding_window(df, time_col, label_col, window_days=7, step_days=1, sav
 
     if save_path:
         plt.savefig(save_path, dpi=300, bbox_inches='tight')
-    plt.show()
+    if show:
+        plt.show()
 
 
-def plot_reinforcement(df, group_col, var='sawl', time_col='time', save_path=None):
+RESAMPLE_UNITS = {
+    "hour": pd.Timedelta(hours=1).value,
+    "day": pd.Timedelta(days=1).value,
+    "week": pd.Timedelta(weeks=1).value,
+}
+WEEK_OFFSET = pd.Timedelta(days=3).value  # the epoch is a Thursday; weeks start on Monday
+
+
+def floor_times(times, freq):
+    """Floor timestamps to 'hour', 'day' or 'week' (Monday) buckets on int64 nanoseconds (UTC)."""
+    ns = pd.to_datetime(times).to_numpy(dtype="datetime64[ns]").view(np.int64)
+    nat = ns == np.iinfo(np.int64).min
+    unit = RESAMPLE_UNITS[freq]
+    offset = WEEK_OFFSET if freq == "week" else 0
+    floored = np.where(nat, ns, (ns + offset) // unit * unit - offset)
+    return floored.view("datetime64[ns]")
+
+
+def reinforcement_series(df, group_col, var='sawl', time_col='time', freq=None):
+    """
+    Min, mean and max of `var` per group and time point (columns: stat x group).
+    With `freq` ('hour', 'day', 'week'), times are floored to buckets first.
+    """
+    times = pd.to_datetime(df[time_col]) if freq is None else floor_times(df[time_col], freq)
+    keys = [df[group_col], pd.Series(times, index=df.index, name=time_col)]
+    return df[var].groupby(keys).agg(['min', 'mean', 'max']).unstack(group_col)
+
+
+def downsample_series(grouped, max_points):
+    """
+    Reduce a `reinforcement_series` table to at most `max_points` rows by merging
+    equal-width time buckets. Each bucket keeps the min of the minima, the max of
+    the maxima and the average mean, so the min-max band keeps its extremes.
+    The bucket is placed at its first timestamp.
+    """
+    if len(grouped) <= max_points:
+        return grouped
+    t = grouped.index.to_numpy(dtype="datetime64[ns]").view(np.int64).astype(float)
+    span = max(t[-1] - t[0], 1)
+    bucket = np.minimum(((t - t[0]) / span * max_points).astype(np.int64), max_points - 1)
+    merged = pd.concat({stat: grouped[stat].groupby(bucket).agg(stat) for stat in ['min', 'mean', 'max']},
+                       axis=1, names=[None, grouped.columns.names[1]])
+    merged.index = grouped.index.to_series().groupby(bucket).first().rename(grouped.index.name)
+    return merged
+
+
+def plot_reinforcement(df, group_col, var='sawl', time_col='time', save_path=None, freq=None, max_points=None,
+                       show=True):
     """
     Plot reinforcement: min-mean-max exposure by group over time.
 
@@ -107,12 +245,15 @@ def plot_reinforcement(df, group_col, var='sawl', time_col='time', save_path=Non
         group_col (str): grouping column (e.g., S_modularity)
         var (str): exposure variable (e.g., sawl)
         time_col (str): datetime column
+        freq (str): optional 'hour', 'day' or 'week' buckets instead of raw timestamps
+        max_points (int): optional maximum number of points per series
+        show (bool): call plt.show() (False for batch rendering)
     """
-    df = df.copy()
-    df[time_col] = pd.to_datetime(df[time_col])
-    grouped = df.groupby([group_col, time_col])[var].agg(['min', 'mean', 'max']).unstack(group_col)
+    grouped = reinforcement_series(df, group_col, var, time_col, freq)
+    if max_points:
+        grouped = downsample_series(grouped, max_points)
 
-    fig, axes = grouped['mean'].plot(subplots=True, figsize=(12, 10), legend=False)
+    axes = grouped['mean'].plot(subplots=True, figsize=(12, 10), legend=False)
     palette = sns.color_palette()
 
     for idx, ax in enumerate(axes):
@@ -131,10 +272,11 @@ def plot_reinforcement(df, group_col, var='sawl', time_col='time', save_path=Non
     plt.tight_layout()
     if save_path:
         plt.savefig(save_path, dpi=300, bbox_inches='tight')
-    plt.show()
+    if show:
+        plt.show()
 
 
-def plot_zoom_inset(x, y, zoom_xlim, zoom_ylim, zoom_factor=5, save_path=None):
+def plot_zoom_inset(x, y, zoom_xlim, zoom_ylim, zoom_factor=5, save_path=None, show=True):
     """
     Create zoomed-in inset plot.
 
@@ -143,6 +285,7 @@ def plot_zoom_inset(x, y, zoom_xlim, zoom_ylim, zoom_factor=5, save_path=None):
         y (array): y-axis data
         zoom_xlim (tuple): x limits of zoomed region
         zoom_ylim (tuple): y limits of zoomed region
+        show (bool): call plt.show() (False for batch rendering)
     """
     fig, ax = plt.subplots(figsize=(8, 5))
     ax.plot(x, y)
@@ -159,4 +302,100 @@ def plot_zoom_inset(x, y, zoom_xlim, zoom_ylim, zoom_factor=5, save_path=None):
     mark_inset(ax, axins, loc1=2, loc2=4, fc="none", ec="0.5")
     if save_path:
         plt.savefig(save_path, dpi=300, bbox_inches='tight')
-    plt.show()
+    if show:
+        plt.show()
+
+
+# A figure for `render_figures`: a plotting function (or its name in this module),
+# the output file and the keyword arguments, including the data.
+FigureSpec = namedtuple("FigureSpec", ["func", "save_path", "kwargs"])
+
+
+def _feed(digest, obj):
+    """Feed a stable byte representation of plot inputs into `digest`."""
+    if isinstance(obj, pd.DataFrame):
+        digest.update(repr((list(obj.columns), [str(t) for t in obj.dtypes])).encode())
+        for col in obj.columns:
+            _feed(digest, obj[col])
+        _feed(digest, obj.index.to_series())
+    elif isinstance(obj, pd.Series):
+        try:
+            hashed = pd.util.hash_pandas_object(obj, index=False)
+        except TypeError:
+            # Unhashable cells such as lists
+            hashed = pd.util.hash_pandas_object(obj.map(repr), index=False)
+        digest.update(hashed.to_numpy().tobytes())
+    elif isinstance(obj, np.ndarray):
+        digest.update(repr((obj.dtype.str, obj.shape)).encode())
+        digest.update(np.ascontiguousarray(obj).tobytes() if obj.dtype != object else repr(obj.tolist()).encode())
+    elif isinstance(obj, CCDFHistogram):
+        digest.update(repr((obj.var, obj.group_col, obj.log_bins)).encode())
+        _feed(digest, obj.counts)
+    elif isinstance(obj, dict):
+        for key in sorted(obj, key=str):
+            digest.update(repr(key).encode())
+            _feed(digest, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        digest.update(f"{type(obj).__name__}{len(obj)}".encode())
+        for item in obj:
+            _feed(digest, item)
+    else:
+        digest.update(repr(obj).encode())
+
+
+def figure_key(spec):
+    """BLAKE2 digest of the plotting function, input data and parameters of a `FigureSpec`."""
+    digest = hashlib.blake2b(digest_size=16)
+    func = spec.func if isinstance(spec.func, str) else f"{spec.func.__module__}.{spec.func.__qualname__}"
+    _feed(digest, [func, str(spec.save_path), spec.kwargs])
+    return digest.hexdigest()
+
+
+def _init_render_worker():
+    """Switch a rendering worker to the non-interactive Agg backend."""
+    plt.switch_backend("Agg")
+
+
+def _render(func, save_path, kwargs):
+    """Worker: render one figure to `save_path`."""
+    func = globals()[func] if isinstance(func, str) else func
+    try:
+        func(save_path=save_path, show=False, **kwargs)
+    finally:
+        plt.close("all")
+    return str(save_path)
+
+
+def render_figures(specs, workers=1, force=False):
+    """
+    Render `FigureSpec`s headless in a pool of `workers` processes.
+    Figures are always drawn in worker processes with the Agg backend, so the
+    caller's backend and open figures are left alone.
+
+    Next to each output a `<file>.json` manifest records the key from `figure_key`;
+    a figure whose file exists with the same key is skipped unless `force`.
+
+    Returns:
+        dict: save_path -> 'rendered' or 'cached'
+    """
+    status, todo = {}, []
+    for spec in specs:
+        key = figure_key(spec)
+        path = Path(spec.save_path)
+        manifest = path.with_name(path.name + ".json")
+        if not force and path.exists() and manifest.exists() and json.loads(manifest.read_text()).get("key") == key:
+            status[str(path)] = "cached"
+        else:
+            todo.append((spec, manifest, key))
+    if not todo:
+        return status
+
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(todo))), initializer=_init_render_worker) as executor:
+        futures = [(executor.submit(_render, spec.func, spec.save_path, spec.kwargs), spec, manifest, key)
+                   for spec, manifest, key in todo]
+        for future, spec, manifest, key in futures:
+            future.result()
+            manifest.write_text(json.dumps({"key": key}))
+            status[str(spec.save_path)] = "rendered"
+            print(f"Rendered {spec.save_path}")
+    return status
@@ -1,12 +1,81 @@
+import numpy as np
 import pandas as pd
 import networkx as nx
-from datetime import datetime, timedelta
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
 
+from centrality_store import CentralityWriter
 
-def parse_iso(timestamp):
-    """Parse ISO string without the 'Z' suffix."""
-    return datetime.fromisoformat(timestamp.rstrip("Z"))
+
+def parse_iso_ns(timestamps):
+    """Parse ISO strings (optional 'Z' suffix) to int64 nanoseconds."""
+    parsed = pd.to_datetime(pd.Series(timestamps).astype(str).str.rstrip("Z"), format="ISO8601")
+    return parsed.to_numpy(dtype="datetime64[ns]").view(np.int64)
+
+
+class SlidingGraph:
+    """
+    Directed graph of the edges inside a sliding window, updated in O(Δ) per step.
+    Duplicate edges are reference-counted, so an edge (and a node) leaves the graph
+    only when its last occurrence leaves the window.
+    """
+
+    def __init__(self):
+        self.G = nx.DiGraph()
+        self.edge_count = {}
+        self.node_count = {}
+        self.in_deg = {}
+        self.out_deg = {}
+
+    def add(self, source, target):
+        for node in (source, target):
+            if self.node_count.get(node, 0) == 0:
+                self.G.add_node(node)
+                self.in_deg[node] = self.out_deg[node] = 0
+            self.node_count[node] = self.node_count.get(node, 0) + 1
+        count = self.edge_count.get((source, target), 0)
+        if count == 0:
+            self.G.add_edge(source, target)
+            self.out_deg[source] += 1
+            self.in_deg[target] += 1
+        self.edge_count[(source, target)] = count + 1
+
+    def remove(self, source, target):
+        count = self.edge_count.pop((source, target)) - 1
+        if count == 0:
+            self.G.remove_edge(source, target)
+            self.out_deg[source] -= 1
+            self.in_deg[target] -= 1
+        else:
+            self.edge_count[(source, target)] = count
+        for node in (source, target):
+            self.node_count[node] -= 1
+            if self.node_count[node] == 0:
+                del self.node_count[node], self.in_deg[node], self.out_deg[node]
+                self.G.remove_node(node)
+
+    def degree_centrality(self, node):
+        """(in-degree, out-degree) centrality as computed by networkx."""
+        n = len(self.G)
+        if n <= 1:
+            return 1, 1
+        s = 1.0 / (n - 1.0)
+        return self.in_deg[node] * s, self.out_deg[node] * s
+
+
+def window_betweenness(G, k=None, seed=None):
+    """
+    Normalized betweenness of one window graph. With `k`, it is estimated from
+    k sampled pivots (exact when k >= number of nodes).
+    """
+    if k is not None and k >= len(G):
+        k = None
+    try:
+        return nx.betweenness_centrality(G, k=k, normalized=True, seed=seed)
+    except Exception:
+        return {}
 
 
 def compute_sliding_centrality(
@@ -15,68 +84,117 @@ def compute_sliding_centrality(
     window_days=7,
     step_days=1,
     time_format='iso',
+    betweenness_k=None,
+    seed=None,
+    workers=1,
+    output_dir=None,
+    user_index=None,
 ):
     """
     Computes node-level betweenness, in-degree, and out-degree centralities
     over sliding windows.
 
+    Timestamps are parsed once and sorted; each window is located with
+    `searchsorted`, and a single graph is updated with the edges entering and
+    leaving the window instead of being rebuilt per step.
+
     Parameters:
         edge_df (pd.DataFrame): Edgelist with time column.
         time_col (str): Name of the time column.
         window_days (int): Width of sliding window (in days).
         step_days (int): Step size between windows.
         time_format (str): 'iso' (default) assumes ISO timestamps.
+        betweenness_k (int): Estimate betweenness from this many sampled pivots
+            per window instead of all nodes (None = exact).
+        seed (int): Seed for pivot sampling; window i uses seed + i.
+        workers (int): Processes computing betweenness of independent windows.
+            Results are collected in window order.
+        output_dir (str|Path): Stream results as typed columns to Parquet
+            partitions here (see `centrality_store`) instead of one DataFrame.
+        user_index (UserIndex): Dictionary for the node codes when writing to
+            `output_dir`; a new one is created if None.
 
     Returns:
-        pd.DataFrame: with columns [Id, time, indegree, outdegree, betweenness]
+        pd.DataFrame: with columns [Id, time, indegree, outdegree, betweenness],
+        or a `CentralityStore` over `output_dir` if given.
     """
     df = edge_df.copy()
-    df[time_col] = df[time_col].map(parse_iso)
+    df[time_col] = parse_iso_ns(df[time_col])
     df = df.sort_values(by=time_col).reset_index(drop=True)
 
-    start = df[time_col].min()
-    end = df[time_col].max()
-
-    results = []
-
-    i = 0
-    while start + timedelta(days=window_days) <= end:
-        slide_end = start + timedelta(days=window_days)
-        print(f"### Window {i}: {start.date()} to {slide_end.date()} ###")
+    times = df[time_col].to_numpy()
+    sources = df["Source"].to_numpy()
+    targets = df["Target"].to_numpy()
+    endpoints = df[["Source", "Target"]].values.ravel()
 
-        temp = df[(df[time_col] >= start) & (df[time_col] < slide_end)]
+    window = pd.Timedelta(days=window_days).value
+    step = pd.Timedelta(days=step_days).value
+    start = times.min()
+    end = times.max()
 
-        if temp.empty:
-            print("No edges in this window.")
-            start += timedelta(days=step_days)
-            i += 1
-            continue
-
-        users = pd.unique(temp[["Source", "Target"]].values.ravel())
-        G = nx.from_pandas_edgelist(temp, "Source", "Target", create_using=nx.DiGraph())
-        G.add_nodes_from(users)
-
-        try:
-            bt = nx.betweenness_centrality(G, normalized=True)
-        except Exception:
-            bt = {}
-
-        try:
-            in_deg = nx.in_degree_centrality(G)
-            out_deg = nx.out_degree_centrality(G)
-        except Exception:
-            in_deg, out_deg = {}, {}
-
-        for node in users:
-            results.append({
-                "Id": node,
+    graph = SlidingGraph()
+    lo = hi = 0
+    writer = CentralityWriter(output_dir, user_index) if output_dir is not None else None
+    results = []
+    pending = deque()
+
+    def collect():
+        i, users, degrees, bt = pending.popleft()
+        if executor is not None:
+            bt = bt.result()
+        degrees = np.array(degrees, dtype=float).reshape(-1, 2)
+        betweenness = np.array([bt.get(node, 0) for node in users], dtype=float)
+        if writer is not None:
+            writer.append(i, users, degrees[:, 0], degrees[:, 1], betweenness)
+        else:
+            results.append(pd.DataFrame({
+                "Id": users,
                 "time": i,
-                "indegree": in_deg.get(node, 0),
-                "outdegree": out_deg.get(node, 0),
-                "betweenness": bt.get(node, 0)
-            })
+                "indegree": degrees[:, 0],
+                "outdegree": degrees[:, 1],
+                "betweenness": betweenness,
+            }))
+
+    with ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as executor:
+        i = 0
+        while start + window <= end:
+            slide_end = start + window
+            print(f"### Window {i}: {pd.Timestamp(start).date()} to {pd.Timestamp(slide_end).date()} ###")
+
+            new_lo = np.searchsorted(times, start, side='left')
+            new_hi = np.searchsorted(times, slide_end, side='left')
+            for k in range(lo, min(new_lo, hi)):
+                graph.remove(sources[k], targets[k])
+            for k in range(max(hi, new_lo), new_hi):
+                graph.add(sources[k], targets[k])
+            lo, hi = new_lo, new_hi
+
+            if lo == hi:
+                print("No edges in this window.")
+                start += step
+                i += 1
+                continue
+
+            users = pd.unique(endpoints[2 * lo:2 * hi])
+            degrees = [graph.degree_centrality(node) for node in users]
+            window_seed = None if seed is None else seed + i
+
+            if executor is None:
+                bt = window_betweenness(graph.G, betweenness_k, window_seed)
+            else:
+                # Snapshot: the shared graph keeps changing while the task is queued
+                bt = executor.submit(window_betweenness, graph.G.copy(), betweenness_k, window_seed)
+            pending.append((i, users, degrees, bt))
+            # Bound the number of window snapshots held in memory
+            while len(pending) > 4 * max(workers, 1) or (executor is None and pending):
+                collect()
+
+            start += step
+            i += 1
 
-        start += timedelta(days=step_days)
-        i += 1
+        while pending:
+            collect()
 
-    return pd.DataFrame(results)
+    if writer is not None:
+        return writer.close()
+    return pd.concat(results, ignore_index=True) if results else pd.DataFrame()
@@ -0,0 +1,125 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pathlib import Path
+
+from user_index import UserIndex
+
+CENTRALITY_SCHEMA = pa.schema([
+    ("node", pa.int32()),
+    ("window", pa.int16()),
+    ("indegree", pa.float32()),
+    ("outdegree", pa.float32()),
+    ("betweenness", pa.float32()),
+])
+METRICS = ["indegree", "outdegree", "betweenness"]
+
+
+class CentralityWriter:
+    """
+    Buffer sliding-window centralities as typed columns and flush them to Parquet
+    files partitioned by window range (part-<first window>-<last window>.parquet).
+
+    Users are stored as int32 codes of a `UserIndex` saved next to the partitions.
+    Rows inside a partition are sorted by node and written in small row groups, so
+    a single user's rows can be found from the Parquet statistics alone.
+    """
+
+    def __init__(self, out_dir, user_index=None, batch_rows=1_000_000, row_group_rows=8192):
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.user_index = user_index if user_index is not None else UserIndex()
+        self.batch_rows = batch_rows
+        self.row_group_rows = row_group_rows
+        self._reset()
+
+    def _reset(self):
+        self.chunks = []
+        self.n_rows = 0
+
+    def append(self, window, users, indegree, outdegree, betweenness):
+        """Append the rows of one window; flush if the batch is full."""
+        if window > np.iinfo(np.int16).max:
+            raise ValueError(f"Window {window} does not fit the int16 window column")
+        nodes = self.user_index.encode(users)
+        self.chunks.append(pa.table([
+            pa.array(nodes, pa.int32()),
+            pa.array(np.full(len(nodes), window, dtype=np.int16)),
+            pa.array(np.asarray(indegree, dtype=np.float32)),
+            pa.array(np.asarray(outdegree, dtype=np.float32)),
+            pa.array(np.asarray(betweenness, dtype=np.float32)),
+        ], schema=CENTRALITY_SCHEMA))
+        self.n_rows += len(nodes)
+        if self.n_rows >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered windows as one partition file."""
+        if self.n_rows == 0:
+            return
+        table = pa.concat_tables(self.chunks)
+        windows = table["window"].to_numpy()
+        order = np.argsort(table["node"].to_numpy(), kind="stable")
+        path = self.out_dir / f"part-{windows[0]:05d}-{windows[-1]:05d}.parquet"
+        pq.write_table(table.take(order), path, row_group_size=self.row_group_rows)
+        print(f"Wrote {self.n_rows} rows to {path.name}")
+        self._reset()
+
+    def close(self):
+        """Flush remaining rows, save the user dictionary and return a `CentralityStore`."""
+        self.flush()
+        self.user_index.save(self.out_dir / "users.pkl")
+        return CentralityStore(self.out_dir)
+
+
+class CentralityStore:
+    """
+    Lazy handle over a directory written by `CentralityWriter`.
+    Queries read only the partitions and row groups that can match.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.files = sorted(str(f) for f in self.path.glob("part-*.parquet"))
+        self.dataset = ds.dataset(self.files, schema=CENTRALITY_SCHEMA, format="parquet")
+        self._user_index = None
+
+    def __len__(self):
+        return self.dataset.count_rows()
+
+    @property
+    def user_index(self):
+        if self._user_index is None:
+            self._user_index = UserIndex.load(self.path / "users.pkl")
+        return self._user_index
+
+    def _decode(self, table):
+        df = table.to_pandas()
+        df.insert(0, "Id", self.user_index.decode(df.pop("node")))
+        return df.rename(columns={"window": "time"})
+
+    def to_pandas(self, windows=None):
+        """All rows (optionally a [lo, hi) window range) as [Id, time, indegree, outdegree, betweenness]."""
+        flt = None
+        if windows is not None:
+            flt = (ds.field("window") >= windows[0]) & (ds.field("window") < windows[1])
+        table = self.dataset.to_table(filter=flt)
+        return self._decode(table.sort_by([("window", "ascending")]))
+
+    def user_series(self, user):
+        """Centrality time series of one user, ordered by window."""
+        code = self.user_index.encode([user], add=False)[0]
+        table = self.dataset.to_table(filter=ds.field("node") == int(code))
+        return self._decode(table.sort_by([("window", "ascending")])).reset_index(drop=True)
+
+    def top_k(self, k=10, metric="betweenness", windows=None):
+        """The k users with the highest `metric` in each window (optionally a [lo, hi) range)."""
+        flt = None
+        if windows is not None:
+            flt = (ds.field("window") >= windows[0]) & (ds.field("window") < windows[1])
+        df = self.dataset.to_table(columns=["node", "window", metric], filter=flt).to_pandas()
+        df = df.sort_values(["window", metric], ascending=[True, False], kind="stable")
+        df = df.groupby("window", sort=False).head(k).reset_index(drop=True)
+        df.insert(0, "Id", self.user_index.decode(df.pop("node")))
+        return df.rename(columns={"window": "time"})
@@ -0,0 +1,135 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pathlib import Path
+
+from ragged import RaggedCodes
+from user_index import encode_columns
+
+DIFFUSION_COLUMNS = ["Source", "Target", "time", "ref", "nr", "retweet", "saw"]
+
+
+class DiffusionWriter:
+    """
+    Buffer diffusion rows and flush them in bounded batches to Parquet files
+    partitioned by `nr` range (part-<first nr>-<last nr>.parquet).
+    Only whole cascades are buffered, so a flush never splits a cascade.
+    With a `UserIndex`, Source and Target are written as int32 user codes.
+    """
+
+    def __init__(self, out_dir, batch_rows=500_000, user_index=None):
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.batch_rows = batch_rows
+        self.user_index = user_index
+        self._reset()
+
+    def _reset(self):
+        self.columns = {col: [] for col in DIFFUSION_COLUMNS}
+        self.n_rows = 0
+
+    def append(self, **rows):
+        """Append one cascade given as equally long lists per column; flush if the batch is full."""
+        for col in DIFFUSION_COLUMNS:
+            self.columns[col] += rows[col]
+        self.n_rows += len(rows["nr"])
+        if self.n_rows >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows as one partition file."""
+        if self.n_rows == 0:
+            return
+        nr = self.columns["nr"]
+        path = self.out_dir / f"part-{nr[0]:010d}-{nr[-1]:010d}.parquet"
+        df = pd.DataFrame(self.columns)
+        if self.user_index is not None:
+            df = encode_columns(df, self.user_index, ["Source", "Target"])
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_table(table, path)
+        print(f"Wrote {self.n_rows} rows to {path.name}")
+        self._reset()
+
+    def close(self):
+        """Flush remaining rows and return a lazy `DiffusionStore` over the output."""
+        self.flush()
+        return DiffusionStore(self.out_dir)
+
+
+class DiffusionStore:
+    """
+    Lazy handle over a partitioned diffusion output directory.
+    Nothing is read until `to_pandas` or `iter_batches` is called, and both
+    read only the requested columns and `nr` range.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.files = sorted(str(f) for f in self.path.glob("part-*.parquet"))
+        schemas = [pq.read_schema(f) for f in self.files]
+        # A batch where a column is entirely missing is written as a null column
+        schema = pa.unify_schemas(schemas, promote_options="permissive") if schemas else None
+        self.dataset = ds.dataset(self.files, schema=schema, format="parquet")
+
+    def __len__(self):
+        return self.dataset.count_rows()
+
+    @property
+    def columns(self):
+        return self.dataset.schema.names
+
+    def _filter(self, nr_range):
+        if nr_range is None:
+            return None
+        lo, hi = nr_range
+        return (ds.field("nr") >= lo) & (ds.field("nr") < hi)
+
+    def to_pandas(self, columns=None, nr_range=None):
+        """Load the selected columns (and optional [lo, hi) `nr` range) as a DataFrame."""
+        return self.dataset.to_table(columns=columns, filter=self._filter(nr_range)).to_pandas()
+
+    def saw_codes(self, nr_range=None):
+        """The `saw` column as a `RaggedCodes`, decoded straight from Arrow."""
+        return RaggedCodes.from_arrow(self.dataset.to_table(columns=["saw"], filter=self._filter(nr_range))["saw"])
+
+    def iter_batches(self, columns=None, nr_range=None, batch_size=100_000):
+        """Yield the selected columns as DataFrames of at most batch_size rows."""
+        for batch in self.dataset.to_batches(columns=columns, filter=self._filter(nr_range), batch_size=batch_size):
+            yield batch.to_pandas()
+
+
+def as_frame(data, columns=None):
+    """Return `data` as a DataFrame, loading only `columns` when it is a `DiffusionStore`."""
+    if isinstance(data, DiffusionStore):
+        return data.to_pandas(columns=columns)
+    return data
+
+
+def iter_frames(data, columns, batch_size=1_000_000):
+    """
+    Yield `data` itself, or the `columns` of a `DiffusionStore` in batches of at
+    most `batch_size` rows, for reductions that can be combined across batches.
+    """
+    if not isinstance(data, DiffusionStore):
+        yield data
+        return
+    missing = [col for col in columns if col not in data.columns]
+    if missing:
+        raise KeyError(f"Diffusion store {data.path} has no column(s) {missing}; "
+                       "add them with the enrichment steps (see `map_store`)")
+    yield from data.iter_batches(columns=columns, batch_size=batch_size)
+
+
+def map_store(store, func, out_dir, **kwargs):
+    """
+    Apply `func(df, **kwargs)` to each partition of `store` and write the resulting
+    frames as the partitions of a new store in `out_dir`, e.g. to add columns.
+    Only one partition is held in memory at a time.
+    """
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    for path in store.files:
+        df = func(pq.read_table(path).to_pandas(), **kwargs)
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), out / Path(path).name)
+    return DiffusionStore(out)
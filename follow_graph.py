@@ -0,0 +1,173 @@
+import pickle
+import numpy as np
+import pandas as pd
+from collections.abc import Mapping
+from functools import lru_cache
+from pathlib import Path
+
+
+def write_follow_graph(following_dict, out_dir):
+    """
+    Write a following dict (e.g. `dict_name.pkl`) as a CSR adjacency on disk.
+
+    Every user and followed name gets an integer code. Row `code` of the CSR holds
+    the codes of the lowercase following list in recency (reversed) order, as used
+    by `cascade_builder.get_ordered_following`.
+    """
+    codes = {user: code for code, user in enumerate(following_dict)}
+    rows = {}
+    for user, following in following_dict.items():
+        names = [str(x).lower() for x in following][::-1]
+        rows[codes[user]] = [codes.setdefault(name, len(codes)) for name in names]
+
+    offsets = np.zeros(len(codes) + 1, dtype=np.int64)
+    for code, row in rows.items():
+        offsets[code + 1] = len(row)
+    np.cumsum(offsets, out=offsets)
+
+    neighbors = np.empty(offsets[-1], dtype=np.int32)
+    for code, row in rows.items():
+        neighbors[offsets[code]:offsets[code + 1]] = row
+
+    return save_csr(out_dir, offsets, neighbors, list(codes))
+
+
+def save_csr(out_dir, offsets, neighbors, names):
+    """Write CSR arrays and the code → name list in the layout read by `FollowGraph`."""
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    np.save(out / "offsets.npy", np.asarray(offsets, dtype=np.int64))
+    np.save(out / "neighbors.npy", np.asarray(neighbors, dtype=np.int32))
+    with open(out / "names.pkl", 'wb') as f:
+        pickle.dump(list(names), f)
+    return out
+
+
+def build_follow_graph_from_crawl(following_csv, users_csv, out_dir):
+    """
+    Convert the raw crawl output of `data_twitter_follow_relationships.py` to a CSR graph.
+
+    Repeated header lines and the `0` placeholders for users without followings are
+    dropped, duplicate (user, fol_id) rows are removed, and IDs are resolved to
+    lowercase usernames through `users_csv` (first name per ID). Pairs whose IDs have
+    no known name are dropped. Neighbor arrays keep the crawl order (the API's
+    most-recent-first order), the same recency order `write_follow_graph` stores.
+    """
+    crawl = pd.read_csv(following_csv, header=None, names=["user", "fol_id"], dtype=str, encoding='utf-8')
+    # Filter on the strings: 19-digit IDs do not survive a float64 round-trip
+    numeric = crawl["user"].str.fullmatch(r"\d+") & crawl["fol_id"].str.fullmatch(r"\d+")
+    crawl = crawl[numeric.fillna(False).astype(bool)].astype("int64")
+    crawl = crawl[crawl["fol_id"] != 0]
+
+    users = pd.read_csv(users_csv, header=None, dtype=str, encoding='utf-8')
+    users = users[users[1].str.fullmatch(r"\d+").fillna(False).astype(bool)].drop_duplicates(subset=[1])
+    id_names = pd.Series(users[2].astype(str).str.lower().to_numpy(), index=users[1].astype("int64").to_numpy())
+
+    user_names = id_names.reindex(crawl["user"].to_numpy()).to_numpy()
+    fol_names = id_names.reindex(crawl["fol_id"].to_numpy()).to_numpy()
+    resolved = pd.notna(user_names) & pd.notna(fol_names)
+
+    codes, names = pd.factorize(np.concatenate([user_names[resolved], fol_names[resolved]]))
+    n_pairs = int(resolved.sum())
+    pairs = (codes[:n_pairs].astype(np.int64) << 32) | codes[n_pairs:]
+    pairs = pairs[~pd.Series(pairs).duplicated().to_numpy()]
+    pairs = pairs[np.argsort(pairs >> 32, kind="stable")]
+    sources = (pairs >> 32).astype(np.int32)
+    neighbors = (pairs & 0xFFFFFFFF).astype(np.int32)
+
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=len(names)), out=offsets[1:])
+
+    print(f"Follow graph: {len(names)} users, {len(neighbors)} edges")
+    return save_csr(out_dir, offsets, neighbors, names)
+
+
+class FollowGraph(Mapping):
+    """
+    Read-only, memory-mapped view of a graph written by `write_follow_graph` or
+    `build_follow_graph_from_crawl`. The offset and neighbor arrays are mapped, so
+    opening is near-instant and processes opening the same directory share the
+    pages instead of holding private copies.
+
+    As a mapping it can stand in for `dictAll`: name → list of followed names.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.offsets = np.load(self.path / "offsets.npy", mmap_mode='r')
+        self.neighbors = np.load(self.path / "neighbors.npy", mmap_mode='r')
+        self._names = None
+        self._name_index = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __getitem__(self, name):
+        code = self.code(name)
+        if code < 0:
+            raise KeyError(name)
+        return [self.names[c] for c in self.neighbor_codes(code).tolist()]
+
+    def __contains__(self, name):
+        return self.code(name) >= 0
+
+    def code(self, name):
+        """Code of `name`, or -1 if it is not in the graph."""
+        if self._name_index is None:
+            self._name_index = pd.Index(self.names, dtype=object)
+        try:
+            return int(self._name_index.get_loc(name))
+        except (KeyError, TypeError):
+            return -1
+
+    @property
+    def names(self):
+        """Code → name list (loaded on first use)."""
+        if self._names is None:
+            with open(self.path / "names.pkl", 'rb') as f:
+                self._names = pickle.load(f)
+        return self._names
+
+    def neighbor_codes(self, code):
+        """Codes of the users followed by `code`, in recency order."""
+        if code < 0 or code >= len(self):
+            return self.neighbors[:0]
+        return self.neighbors[self.offsets[code]:self.offsets[code + 1]]
+
+    def following_set(self, code):
+        """Set of the codes followed by `code`, for membership tests."""
+        return frozenset(self.neighbor_codes(code).tolist())
+
+    def ranks(self, code):
+        """Rank map {followed code: [ranks]} for `code`, see `cascade_builder.get_rank_map`."""
+        ranks = {}
+        for rank, name in enumerate(self.neighbor_codes(code).tolist()):
+            ranks.setdefault(name, []).append(rank)
+        return ranks
+
+
+class NameRanks:
+    """
+    `following_index` view of a `FollowGraph` for `cascade_builder`:
+    user name → {followed name: [ranks]}, decoded on demand. Decoded maps of the
+    `cache_size` most recently used users are cached, since a user is looked up
+    on every row of every cascade they take part in.
+    """
+
+    def __init__(self, graph, cache_size=1 << 16):
+        self.graph = graph
+        self._cached_ranks = lru_cache(maxsize=cache_size)(self._decode_ranks)
+
+    def _decode_ranks(self, user):
+        code = self.graph.code(user)
+        if code < 0:
+            return None
+        names = self.graph.names
+        return {names[c]: ranks for c, ranks in self.graph.ranks(code).items()}
+
+    def get(self, user, default=None):
+        ranks = self._cached_ranks(user)
+        return default if ranks is None else ranks
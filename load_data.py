@@ -1,5 +1,14 @@
+import hashlib
+import json
+import sys
+import threading
+import time
 import pandas as pd
 import pickle
+import pyarrow as pa
+import pyarrow.feather as feather
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 
@@ -14,25 +23,152 @@ def load_pickle(path):
         return pickle.load(f)
 
 
-def load_all_data(base_dir):
+def file_hash(path, chunk_size=1 << 20):
+    """BLAKE2 digest of a file's content."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint(path, previous=None):
+    """
+    Return {size, mtime, hash} for a source file.
+    The content hash is only recomputed when size or mtime differ from `previous`.
     """
-    Load all required data files and return as dictionary.
-    Paths are relative to the given base directory.
+    stat = Path(path).stat()
+    if previous and previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime_ns:
+        return previous
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": file_hash(path)}
+
+
+def load_csv_cached(path, cache_dir, columns=None, **kwargs):
+    """
+    Load a CSV through a Feather cache in `cache_dir`.
+
+    The first load parses the CSV and writes an uncompressed Feather copy; later
+    loads memory-map that copy and read only `columns`. The cache is rebuilt when
+    the source's content hash or the read options change (a file that was only
+    touched keeps its cache).
+    """
+    path = Path(path)
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    data_path = cache_dir / f"{path.name}.feather"
+    meta_path = cache_dir / f"{path.name}.json"
+
+    options = repr(sorted(kwargs.items()))
+    meta = json.loads(meta_path.read_text()) if meta_path.exists() else None
+    source = fingerprint(path, meta["source"] if meta else None)
+
+    if meta and data_path.exists() and meta["options"] == options and meta["source"]["hash"] == source["hash"]:
+        if meta["source"] != source:
+            meta["source"] = source
+            meta_path.write_text(json.dumps(meta))
+        # Feather needs string column names; map back to the original labels
+        labels = dict(zip(map(str, meta["columns"]), meta["columns"]))
+        names = None if columns is None else [str(col) for col in columns]
+        df = feather.read_table(data_path, columns=names, memory_map=True).to_pandas()
+        return df.rename(columns=labels)
+
+    df = load_csv(path, **kwargs)
+    try:
+        feather.write_feather(df.rename(columns=str), data_path, compression='uncompressed')
+    except (pa.ArrowException, TypeError, ValueError) as e:
+        print(f"Not caching {path.name}: {e}")
+    else:
+        meta = {"source": source, "options": options, "columns": df.columns.tolist()}
+        meta_path.write_text(json.dumps(meta))
+        print(f"Cached {path.name}")
+    return df if columns is None else df[columns]
+
+
+def memory_usage(obj):
+    """Approximate in-memory size in bytes of a loaded dataset."""
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(sys.getsizeof(v) for v in obj.values())
+    return sys.getsizeof(obj)
+
+
+class LazyData(Mapping):
+    """
+    Read-only mapping of dataset name → data that loads each entry on first access.
+    Load time and memory of every loaded entry are kept in `stats`.
+    """
+
+    def __init__(self, loaders):
+        self._loaders = dict(loaders)
+        self._data = {}
+        self._locks = {key: threading.Lock() for key in self._loaders}
+        self.stats = {}
+
+    def __getitem__(self, key):
+        if key not in self._data:
+            with self._locks[key]:
+                if key not in self._data:
+                    start = time.perf_counter()
+                    value = self._loaders[key]()
+                    seconds = time.perf_counter() - start
+                    self.stats[key] = {"seconds": seconds, "bytes": memory_usage(value)}
+                    print(f"Loaded {key} in {seconds:.1f}s ({self.stats[key]['bytes'] / 1e6:.1f} MB)")
+                    self._data[key] = value
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._loaders)
+
+    def __len__(self):
+        return len(self._loaders)
+
+    def is_loaded(self, key):
+        return key in self._data
+
+    def prefetch(self, keys=None, workers=4):
+        """Load the given keys (default: all) concurrently in a thread pool."""
+        keys = list(self._loaders) if keys is None else list(keys)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(self.__getitem__, keys))
+        return self
+
+    def report(self):
+        """DataFrame of load seconds and bytes for every loaded key."""
+        return pd.DataFrame.from_dict(self.stats, orient='index', columns=["seconds", "bytes"])
+
+
+def load_all_data(base_dir, cache_dir=None, columns=None):
+    """
+    Return a lazy mapping (`LazyData`) of all data files; each file is loaded on
+    first access. Paths are relative to the given base directory.
+    If `cache_dir` is given, CSVs are loaded through `load_csv_cached`.
+    `columns` maps dataset names to the columns to load for that CSV (default: all);
+    cached files keep every column, so a later run may select others.
     """
     base = Path(base_dir)
+    columns = columns or {}
+
+    def csv(name, key, **kwargs):
+        cols = columns.get(key)
+        if cache_dir is not None:
+            return lambda: load_csv_cached(base / name, cache_dir, columns=cols, **kwargs)
+        if cols is None:
+            return lambda: load_csv(base / name, **kwargs)
+        return lambda: load_csv(base / name, usecols=cols, **kwargs)[cols]
 
-    data = {
-        "tweets": load_csv(base / "tweet_df_ordered.csv", dtype={'ref': "string"}),
-        "umap": load_csv(base / "tweet_umap.csv", dtype={'ref': "string"}),
-        "users": load_csv(base / "users_df.csv", header=None),
-        "name_dict": load_pickle(base / "dict_name.pkl"),
-        "diff_gephi": load_csv(base / "diff_gephi.csv"),
-        "diff_sto": load_csv(base / "diff_gephi_sto.csv"),
-        "diff_sto_cross": load_csv(base / "diff_gephi_sto_cross.csv"),
-        "classified": load_csv(base / "tweet_df_classified14.csv"),
-        "user_modularity": load_csv(base / "gephi_mod1.1_380_439+des.csv"),
-        "centrality": load_csv(base / "diff_gephi_centrality.csv"),
-        "diff_gephi_mod": load_csv(base / "diff_gephi_mod.csv"),
+    loaders = {
+        "tweets": csv("tweet_df_ordered.csv", "tweets", dtype={'ref': "string"}),
+        "umap": csv("tweet_umap.csv", "umap", dtype={'ref': "string"}),
+        "users": csv("users_df.csv", "users", header=None),
+        "name_dict": lambda: load_pickle(base / "dict_name.pkl"),
+        "diff_gephi": csv("diff_gephi.csv", "diff_gephi"),
+        "diff_sto": csv("diff_gephi_sto.csv", "diff_sto"),
+        "diff_sto_cross": csv("diff_gephi_sto_cross.csv", "diff_sto_cross"),
+        "classified": csv("tweet_df_classified14.csv", "classified"),
+        "user_modularity": csv("gephi_mod1.1_380_439+des.csv", "user_modularity"),
+        "centrality": csv("diff_gephi_centrality.csv", "centrality"),
+        "diff_gephi_mod": csv("diff_gephi_mod.csv", "diff_gephi_mod"),
     }
 
-    return data
+    return LazyData(loaders)
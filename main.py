@@ -3,7 +3,8 @@ from pathlib import Path
 from load_data import load_all_data
 from preprocess import preprocess_retweets
 from cascade_builder import build_diffusion_trees
-from analysis import (
+from user_index import UserIndex
+from cascade_analysis import (
     label_retweets_by_content,
     assign_modularity_groups,
     mark_top_users,
@@ -13,22 +14,32 @@ from analysis import (
     compute_indirect_exposure_rate,
     groupwise_top_exposure
 )
-from visualization import (
-    plot_ccdf,
-    plot_sliding_window,
-    plot_reinforcement
+from cascade_visualization import (
+    FigureSpec,
+    render_figures
 )
 
 # ========== CONFIGURATION ==========
 BASE_DIR = Path("/Users/xixuan/Desktop/twitter_test/fff_api_alltweets")
 PIC_DIR = BASE_DIR / "pic"
 PIC_DIR.mkdir(exist_ok=True)
+CACHE_DIR = BASE_DIR / "cache"  # Feather copies of the CSV inputs
+USER_INDEX_FILE = BASE_DIR / "user_index.pkl"  # Shared username -> int32 code dictionary
 
 TOP_K_PERCENT = 0.01  # Top centrality users
+PLOT_WORKERS = 3  # Figures rendered in parallel; unchanged figures are skipped
+# Columns read from the wide CSVs (tweets keeps all: preprocess_retweets expects its full layout)
+LOAD_COLUMNS = {
+    "umap": ["post", "user"],
+    "classified": ["post", "label_manual"],
+    "user_modularity": ["Id", "modularity_class"],
+    "centrality": ["Id", "eigencentrality"],
+}
 
 # ========== STEP 1: Load data ==========
 print("Loading data...")
-data = load_all_data(BASE_DIR)
+data = load_all_data(BASE_DIR, cache_dir=CACHE_DIR, columns=LOAD_COLUMNS)
+data.prefetch(["tweets", "umap", "users", "name_dict", "classified", "user_modularity", "centrality"])
 
 # ========== STEP 2: Preprocess retweets ==========
 print("Preprocessing retweets...")
@@ -49,13 +60,15 @@ contents_posted = retweet_df.groupby("ref").agg({
 }).reset_index().rename(columns={"ref": "contents", "user": "users", "date": "time", "refu": "refu", "post": "retweets"})
 
 dict_refu = retweet_df.groupby("ref")["refu"].apply(list).to_dict()
-diffusion_df = build_diffusion_trees(contents_posted, dict_refu, data["name_dict"])
+user_index = UserIndex.load(USER_INDEX_FILE) if USER_INDEX_FILE.exists() else UserIndex()
+diffusion_df = build_diffusion_trees(contents_posted, dict_refu, data["name_dict"], user_index=user_index)
 
 # ========== STEP 4: Label + Community Info ==========
 print("Attaching labels and modularity groups...")
 diffusion_df = label_retweets_by_content(diffusion_df, data["classified"])
-diffusion_df = assign_modularity_groups(diffusion_df, data["user_modularity"])
-diffusion_df = mark_top_users(diffusion_df, data["centrality"], top_k=TOP_K_PERCENT)
+diffusion_df = assign_modularity_groups(diffusion_df, data["user_modularity"], user_index=user_index)
+diffusion_df = mark_top_users(diffusion_df, data["centrality"], top_k=TOP_K_PERCENT, user_index=user_index)
+user_index.save(USER_INDEX_FILE)
 
 # ========== STEP 5: Descriptive Analysis ==========
 print("Running analysis...")
@@ -75,32 +88,32 @@ print(top_exposures)
 # ========== STEP 6: Visualization ==========
 print("Generating plots...")
 
-# CCDF of exposure count by community
-plot_ccdf(
-    df=diffusion_df,
-    var="sawl",
-    group_col="S_modularity",
-    top_labels=["right", "fff", "liberalleft"],
-    save_path=PIC_DIR / "ccdf_exposure_by_community.png"
-)
-
-# Timeline of topic spread
-plot_sliding_window(
-    df=diffusion_df,
-    time_col="time",
-    label_col="label",
-    window_days=7,
-    step_days=1,
-    save_path=PIC_DIR / "label_timeline.png"
-)
+render_figures([
+    # CCDF of exposure count by community
+    FigureSpec("plot_ccdf", PIC_DIR / "ccdf_exposure_by_community.png", dict(
+        df=diffusion_df[["sawl", "S_modularity"]],
+        var="sawl",
+        group_col="S_modularity",
+        top_labels=["right", "fff", "liberalleft"]
+    )),
+    # Timeline of topic spread
+    FigureSpec("plot_sliding_window", PIC_DIR / "label_timeline.png", dict(
+        df=diffusion_df[["time", "label"]],
+        time_col="time",
+        label_col="label",
+        window_days=7,
+        step_days=1
+    )),
+    # Reinforcement plot
+    FigureSpec("plot_reinforcement", PIC_DIR / "reinforcement.png", dict(
+        df=diffusion_df[["S_modularity", "sawl", "time"]],
+        group_col="S_modularity",
+        var="sawl",
+        time_col="time"
+    )),
+], workers=PLOT_WORKERS)
 
-# Reinforcement plot
-plot_reinforcement(
-    df=diffusion_df,
-    group_col="S_modularity",
-    var="sawl",
-    time_col="time",
-    save_path=PIC_DIR / "reinforcement.png"
-)
+print("\nLoad times and memory per dataset:")
+print(data.report())
 
 print("Done.")
@@ -1,4 +1,16 @@
+import io
+import os
+import pickle
+import numpy as np
 import pandas as pd
+from pathlib import Path
+
+# Header-less layouts written by data_twitter_user_post.py, mapped onto the names used here:
+# tweet_df.csv is time,id,author_id,text,ref_type,ref_id; users_df.csv is id,username
+# (labelled 1 and 2 as in the indexed users file read by `clean_usernames`).
+COLLECTOR_TWEET_COLUMNS = ["date", "post", "author", "content", "type", "ref"]
+COLLECTOR_USER_COLUMNS = [1, 2]
+RETWEET_COLUMNS = ['date', 'post', 'author', 'content', 'type', 'ref', 'refu', 'user']
 
 
 def filter_retweets(tweet_df):
@@ -18,7 +30,8 @@ def filter_valid_refs(ref_dict, valid_refs):
     """
     Remove entries from ref_dict whose keys are not in valid_refs.
     """
-    invalid_keys = set(map(int, ref_dict.keys())) - set(valid_refs)
+    keys = pd.Index(list(ref_dict)).astype(int)
+    invalid_keys = keys[~keys.isin(valid_refs)].unique()
     for key in invalid_keys:
         ref_dict.pop(str(key), None)
     return ref_dict
@@ -29,30 +42,64 @@ def flatten_dict_values(d):
     return [item for sublist in d.values() for item in sublist]
 
 
+def select_valid_retweets(retweet_df, valid_posts):
+    """
+    Keep retweets whose post ID also occurs in a retweet of a ref contained in valid_posts.
+    Vectorized equivalent of build_ref_to_retweets → filter_valid_refs → flatten_dict_values.
+    """
+    ref = retweet_df["ref"]
+    has_ref = ref.notna()
+    valid = np.zeros(len(retweet_df), dtype=bool)
+    valid[has_ref.to_numpy()] = ref[has_ref].astype("int64").isin(valid_posts).to_numpy()
+    return retweet_df[retweet_df["post"].isin(retweet_df.loc[valid, "post"])]
+
+
+def first_by_key(df, key, value):
+    """Series key → value of the first row per key (rows with a missing key are dropped)."""
+    first = df.drop_duplicates(subset=[key]).dropna(subset=[key])
+    return pd.Series(first[value].to_numpy(), index=first[key].to_numpy())
+
+
+def lookup(keys, table):
+    """Vectorized `table.get(key)` over keys, with None for missing keys."""
+    index = table.index
+    keys = np.asarray(keys)
+    if index.dtype != keys.dtype:
+        # Match dict semantics exactly, e.g. int IDs against a float index with NaN
+        index = index.astype(object)
+        keys = keys.astype(object)
+    pos = index.get_indexer(keys)
+    found = pos >= 0
+    values = np.full(len(pos), None, dtype=object)
+    values[found] = table.to_numpy()[pos[found]]
+    return values
+
+
 def clean_usernames(users_df):
     """
     Lowercase usernames, drop duplicates on ID (column 1), and
-    return a mapping from user ID to lowercase username.
+    return a Series mapping user ID to lowercase username.
     """
-    users_df[2] = users_df[2].astype(str).str.lower()
     users_df = users_df.drop_duplicates(subset=[1])
-    return users_df.groupby(1)[2].apply(list).to_dict()
+    names = users_df[2].astype(str).str.lower()
+    return pd.Series(names.to_numpy(), index=users_df[1].to_numpy())[users_df[1].notna().to_numpy()]
 
 
 def update_usernames(retweet_df, ref_user_map, user_map):
     """
     Add resolved usernames to 'refu' (retweeted-from user)
     and 'user' (current user) columns.
+    `ref_user_map` (post → author ID) and `user_map` (ID → username) are Series.
     """
-    retweet_df['refu'] = retweet_df['ref'].astype(int).map(lambda ref: ref_user_map.get(ref, [None])[0])
-    retweet_df['refu'] = retweet_df['refu'].map(lambda uid: user_map.get(uid, [None])[0])
-    retweet_df['user'] = retweet_df['user'].astype(int).map(lambda uid: user_map.get(uid, [None])[0])
+    ref_users = lookup(retweet_df['ref'].astype(int), ref_user_map)
+    retweet_df['refu'] = pd.Series(lookup(ref_users, user_map), index=retweet_df.index)
+    retweet_df['user'] = pd.Series(lookup(retweet_df['user'].astype(int), user_map), index=retweet_df.index)
     return retweet_df
 
 
 def finalize_retweet_columns(retweet_df):
     """Rename columns and return final cleaned DataFrame."""
-    retweet_df.columns = ['date', 'post', 'author', 'content', 'type', 'ref', 'refu', 'user']
+    retweet_df.columns = RETWEET_COLUMNS
     return retweet_df
 
 
@@ -60,21 +107,11 @@ def preprocess_retweets(tweet_df, umap_df, users_df):
     """Main preprocessing pipeline."""
     retweet_df = filter_retweets(tweet_df)
 
-    # Build ref -> [retweet_post_ids]
-    ref_to_retweets = build_ref_to_retweets(retweet_df)
-
-    # Remove ref entries that don't exist in umap
-    valid_posts = umap_df["post"].tolist()
-    ref_to_retweets = filter_valid_refs(ref_to_retweets, valid_posts)
-
-    # Flatten valid retweet IDs
-    flattened_retweets = flatten_dict_values(ref_to_retweets)
-
-    # Filter retweet_df to valid entries only
-    retweet_df = retweet_df[retweet_df["post"].isin(flattened_retweets)]
+    # Keep retweets of refs that exist in umap
+    retweet_df = select_valid_retweets(retweet_df, umap_df["post"])
 
     # Build post -> user map from umap
-    ref_user_map = umap_df.groupby("post")["user"].apply(list).to_dict()
+    ref_user_map = first_by_key(umap_df, "post", "user")
 
     # Build user ID -> lowercase username map
     user_map = clean_usernames(users_df)
@@ -86,3 +123,146 @@ def preprocess_retweets(tweet_df, umap_df, users_df):
     retweet_df = finalize_retweet_columns(retweet_df)
 
     return retweet_df
+
+
+def read_appended_csv(path, offset, columns=None, **kwargs):
+    """
+    Read the complete lines appended to a CSV since byte `offset`.
+    Returns (DataFrame or None, new offset); a partially written last line is left
+    for the next call. Rows after the start of the file are read with `columns`.
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    if end == 0:
+        return None, offset
+    if offset > 0 and kwargs.get("header", "infer") is not None:
+        kwargs = dict(kwargs, header=None, names=columns)
+    df = pd.read_csv(io.BytesIO(data[:end]), encoding='utf-8', **kwargs)
+    return df, offset + end
+
+
+def load_preprocess_state(state_path):
+    """Load the incremental preprocessing state, or an empty state on the first run."""
+    if Path(state_path).exists():
+        with open(state_path, 'rb') as f:
+            return pickle.load(f)
+    return {
+        "tweet_offset": 0,
+        "tweet_columns": None,
+        "users_offset": 0,
+        "users_columns": None,
+        "user_map": pd.Series(dtype=object),
+        "ref_user_map": pd.Series(dtype=object),
+        "valid_refs": pd.Index([]),
+        "pending": None,
+        "run": 0,
+        "out_size": 0,
+    }
+
+
+def save_preprocess_state(state, state_path):
+    """Write the state atomically so an interrupted run keeps the previous checkpoint."""
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def append_new_keys(table, new):
+    """Extend a lookup Series with keys it does not contain yet (first occurrence wins)."""
+    new = new[~new.index.isin(table.index)]
+    return new if table.empty else pd.concat([table, new])
+
+
+def truncate_output(out_path, size):
+    """Cut `out_path` back to `size` bytes, dropping rows appended after the last checkpoint."""
+    if Path(out_path).exists() and os.path.getsize(out_path) > size:
+        with open(out_path, 'r+b') as f:
+            f.truncate(size)
+        print(f"Truncated {out_path} to the last checkpoint ({size} bytes)")
+
+
+def preprocess_retweets_incremental(tweet_path, users_path, state_path, out_path, umap_df=None,
+                                    tweet_kwargs=None, users_kwargs=None, max_pending_runs=30):
+    """
+    Incremental version of `preprocess_retweets` for CSVs that collectors append to.
+
+    The user map, the ref → author map, the valid refs and the byte offsets reached
+    in `tweet_path` and `users_path` are kept in `state_path`. Each run reads only the
+    rows appended since the last checkpoint, extends the maps (`umap_df` holds new
+    umap rows, if any) and appends the cleaned retweets to `out_path`.
+
+    By default both files are read in the header-less collector layout
+    (`COLLECTOR_TWEET_COLUMNS`, `COLLECTOR_USER_COLUMNS`); pass `tweet_kwargs` /
+    `users_kwargs` for other layouts. In the collector layout, `author` keeps the
+    author ID and `user` holds the author's resolved name.
+
+    Retweets whose ref is not in the umap yet are kept in the state and retried on
+    later runs, so they are written (after newer rows) once their ref arrives.
+    Refs outside the umap corpus never arrive, so rows still pending after
+    `max_pending_runs` runs are dropped, as `preprocess_retweets` drops them.
+    The size of `out_path` is checkpointed with the offsets; rows appended by a run
+    that stopped before saving its state are truncated and written again.
+    Rows are resolved with the maps as of the run that writes them; names that
+    arrive later do not update rows already written.
+    Returns the newly cleaned retweets.
+    """
+    if tweet_kwargs is None:
+        tweet_kwargs = {"header": None, "names": COLLECTOR_TWEET_COLUMNS, "dtype": {'ref': "string"}}
+    if users_kwargs is None:
+        users_kwargs = {"header": None, "names": COLLECTOR_USER_COLUMNS}
+    state = load_preprocess_state(state_path)
+    state["run"] = state.get("run", 0) + 1
+    if "out_size" not in state:
+        state["out_size"] = os.path.getsize(out_path) if Path(out_path).exists() else 0
+    truncate_output(out_path, state["out_size"])
+
+    users_df, state["users_offset"] = read_appended_csv(users_path, state["users_offset"],
+                                                        state["users_columns"], **users_kwargs)
+    if users_df is not None:
+        state["users_columns"] = state["users_columns"] or users_df.columns.tolist()
+        state["user_map"] = append_new_keys(state["user_map"], clean_usernames(users_df))
+
+    if umap_df is not None:
+        state["ref_user_map"] = append_new_keys(state["ref_user_map"], first_by_key(umap_df, "post", "user"))
+        state["valid_refs"] = state["valid_refs"].append(pd.Index(umap_df["post"])).unique()
+
+    tweet_df, state["tweet_offset"] = read_appended_csv(tweet_path, state["tweet_offset"],
+                                                        state["tweet_columns"], **tweet_kwargs)
+    if tweet_df is not None:
+        state["tweet_columns"] = state["tweet_columns"] or tweet_df.columns.tolist()
+        candidates = filter_retweets(tweet_df).assign(pending_since=state["run"])
+    else:
+        candidates = None
+    pending = state.get("pending")
+    if pending is not None and len(pending):
+        if "pending_since" not in pending.columns:
+            pending = pending.assign(pending_since=state["run"])
+        expired = (pending["pending_since"] <= state["run"] - max_pending_runs).to_numpy()
+        if expired.any():
+            print(f"Dropped {expired.sum()} retweets whose ref did not arrive within {max_pending_runs} runs")
+            pending = pending[~expired]
+        candidates = pending if candidates is None else pd.concat([pending, candidates])
+
+    retweet_df = None
+    if candidates is not None:
+        candidates = candidates.reset_index(drop=True)
+        retweet_df = select_valid_retweets(candidates, state["valid_refs"]).copy()
+        rest = candidates.drop(retweet_df.index)
+        state["pending"] = rest[rest["ref"].notna()]
+        retweet_df = retweet_df.drop(columns="pending_since")
+        if "user" in retweet_df.columns:
+            retweet_df = finalize_retweet_columns(
+                update_usernames(retweet_df, state["ref_user_map"], state["user_map"]))
+        else:
+            # Collector layout: keep the author ID and resolve the retweeting user's name
+            retweet_df["user"] = retweet_df["author"]
+            retweet_df = update_usernames(retweet_df, state["ref_user_map"], state["user_map"])[RETWEET_COLUMNS]
+        retweet_df.to_csv(out_path, mode='a', header=state["out_size"] == 0, index=False)
+        state["out_size"] = os.path.getsize(out_path)
+        print(f"Appended {len(retweet_df)} retweets to {out_path} ({len(state['pending'])} pending)")
+
+    save_preprocess_state(state, state_path)
+    return retweet_df
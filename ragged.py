@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+
+
+class RaggedCodes:
+    """
+    Compact ragged array of user lists, e.g. the `saw` exposure column.
+
+    Row i holds `names[values[offsets[i]:offsets[i + 1]]]`: `offsets` is an int64
+    array of length n + 1, `values` an int32 array of codes into `names`.
+    """
+
+    def __init__(self, offsets, values, names):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.int32)
+        self.names = np.asarray(names, dtype=object)
+
+    @classmethod
+    def from_lists(cls, lists, names=None):
+        """
+        Encode a sequence of lists. With a given `names` vocabulary, codes follow it and
+        unseen names are appended; otherwise codes are assigned in order of appearance.
+        """
+        lengths = np.fromiter((len(x) for x in lists), dtype=np.int64, count=len(lists))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        flat = pd.Series([name for x in lists for name in x], dtype=object)
+        if names is None:
+            values, names = pd.factorize(flat, use_na_sentinel=False)
+            names = np.asarray(names, dtype=object)
+            names[pd.isna(names)] = None
+            return cls(offsets, values, names)
+        names = np.array(list(names) + list(flat[~flat.isin(names)].unique()), dtype=object)
+        return cls(offsets, pd.Index(names, dtype=object).get_indexer(flat), names)
+
+    @classmethod
+    def from_arrow(cls, array):
+        """Decode an Arrow list<string> or list<dictionary<string>> (chunked) array."""
+        chunks = array.chunks if isinstance(array, pa.ChunkedArray) else [array]
+        lengths = [pc.fill_null(pc.list_value_length(chunk), 0).to_numpy() for chunk in chunks]
+        offsets = np.zeros(sum(len(x) for x in lengths) + 1, dtype=np.int64)
+        np.cumsum(np.concatenate(lengths) if lengths else [], out=offsets[1:])
+        flats = [chunk.flatten() for chunk in chunks]
+        flat = pa.chunked_array([x.cast(x.type.value_type) if pa.types.is_dictionary(x.type) else x for x in flats],
+                                type=pa.string()).combine_chunks()
+        flat = pc.dictionary_encode(flat, null_encoding='encode')
+        return cls(offsets, flat.indices.to_numpy(zero_copy_only=False), flat.dictionary.to_pylist())
+
+    def to_arrow(self):
+        """Arrow list<dictionary<string>> array sharing the codes."""
+        missing = pd.isna(self.names)
+        # Missing names become null entries; Parquet cannot store nulls inside a dictionary
+        indices = pa.array(self.values, mask=missing[self.values])
+        dictionary = pa.array(np.where(missing, "", self.names).tolist(), pa.string())
+        values = pa.DictionaryArray.from_arrays(indices, dictionary)
+        return pa.LargeListArray.from_arrays(pa.array(self.offsets), values)
+
+    def to_lists(self):
+        """Decode to a list of Python lists of names."""
+        decoded = self.names[self.values].tolist()
+        return [decoded[lo:hi] for lo, hi in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.names[self.values[self.offsets[i]:self.offsets[i + 1]]].tolist()
+
+    def lengths(self):
+        """Number of elements per row (e.g. exposure counts)."""
+        return np.diff(self.offsets)
+
+    def row_ids(self):
+        """Row index of every element of `values`."""
+        return np.repeat(np.arange(len(self)), self.lengths())
+
+    def last(self, default=None):
+        """Last name per row, `default` for empty rows."""
+        lengths = self.lengths()
+        result = np.full(len(self), default, dtype=object)
+        nonempty = lengths > 0
+        result[nonempty] = self.names[self.values[self.offsets[1:][nonempty] - 1]]
+        return result
+
+    def code(self, name):
+        """Code of `name`, or -1 if it does not occur."""
+        matches = np.flatnonzero(pd.isna(self.names) if name is None else self.names == name)
+        return int(matches[0]) if len(matches) else -1
+
+    def contains(self, name):
+        """Boolean array: does each row contain `name`?"""
+        result = np.zeros(len(self), dtype=bool)
+        code = self.code(name)
+        if code >= 0:
+            result[self.row_ids()[self.values == code]] = True
+        return result
+
+    def code_counts(self):
+        """Number of occurrences of each code across all rows."""
+        return np.bincount(self.values, minlength=len(self.names))
+
+
+def write_ragged(ragged, path, column="saw"):
+    """Write a `RaggedCodes` as a one-column uncompressed Feather file."""
+    feather.write_feather(pa.table({column: ragged.to_arrow()}), path, compression='uncompressed')
+
+
+def read_ragged(path, column="saw"):
+    """Memory-map a Feather file written by `write_ragged` back into a `RaggedCodes`."""
+    return RaggedCodes.from_arrow(feather.read_table(path, columns=[column], memory_map=True)[column])
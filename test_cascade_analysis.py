@@ -0,0 +1,35 @@
+import pandas as pd
+
+from cascade_analysis import assign_modularity_groups, count_group_distribution
+from diffusion_store import DiffusionWriter, map_store
+from user_index import UserIndex
+
+
+def _write_store(tmp_path, cascades, batch_rows=1):
+    writer = DiffusionWriter(tmp_path / "diffusion", batch_rows=batch_rows)
+    for nr, (users, targets) in enumerate(cascades):
+        n = len(users)
+        writer.append(Source=users, Target=targets, time=["2020-01-01"] * n, ref=[str(nr)] * n,
+                      nr=[nr] * n, retweet=list(range(n)), saw=[[] for _ in range(n)])
+    return writer.close()
+
+
+def _add_refu(cascade_df):
+    cascade_df["refu"] = cascade_df["Target"]
+    return cascade_df
+
+
+def test_store_modularity_with_integer_classes(tmp_path):
+    # one partition per cascade: all known, all unknown ("999") and mixed users
+    store = _write_store(tmp_path, [(["a", "b"], ["b", "a"]), (["x", "y"], ["y", "x"]), (["a", "x"], ["x", "a"])])
+    store = map_store(store, _add_refu, tmp_path / "refu")
+    modularity = pd.DataFrame({"Id": ["a", "b", "c"], "modularity_class": [1, 2, 2]})
+
+    for user_index in (None, UserIndex()):
+        out = assign_modularity_groups(store, modularity, user_index=user_index,
+                                       out_dir=tmp_path / f"mod-{user_index is None}")
+        df = out.to_pandas(columns=["Source", "S_modularity", "T_modularity"])
+        assert df["S_modularity"].tolist() == ["1", "2", "999", "999", "1", "999"]
+        assert df["T_modularity"].tolist() == ["2", "1", "999", "999", "999", "1"]
+        counts = count_group_distribution(out, "S_modularity")
+        assert dict(zip(counts["S_modularity"], counts["count"])) == {"1": 2, "2": 1, "999": 3}
@@ -0,0 +1,36 @@
+import numpy as np
+
+from follow_graph import FollowGraph, build_follow_graph_from_crawl, write_follow_graph
+
+
+def test_crawl_keeps_19_digit_ids_with_repeated_headers(tmp_path):
+    following = tmp_path / "following_df.csv"
+    following.write_text(
+        "user,fol_id\n"
+        "1234567890123456789,1234567890123456790\n"
+        "1234567890123456789,1234567890123456791\n"
+        "user,fol_id\n"
+        "1234567890123456790,1234567890123456791\n"
+        "1234567890123456790,1234567890123456789\n"
+        "1234567890123456789,1234567890123456790\n"
+        "1234567890123456791,0\n"
+    )
+    users = tmp_path / "users_df.csv"
+    users.write_text(
+        "0,1234567890123456789,Alice\n"
+        "1,1234567890123456790,Bob\n"
+        "2,1234567890123456791,Carol\n"
+    )
+
+    graph = FollowGraph(build_follow_graph_from_crawl(following, users, tmp_path / "graph"))
+
+    assert graph["alice"] == ["bob", "carol"]
+    assert graph["bob"] == ["carol", "alice"]
+    assert graph["carol"] == []
+    assert len(graph.neighbors) == 4
+
+
+def test_crawl_and_dict_graphs_share_recency_order(tmp_path):
+    graph = FollowGraph(write_follow_graph({"alice": ["Carol", "Bob"]}, tmp_path))
+    assert graph["alice"] == ["bob", "carol"]
+    assert np.array_equal(graph.neighbor_codes(graph.code("alice")), [graph.code("bob"), graph.code("carol")])
@@ -0,0 +1,93 @@
+import pickle
+import numpy as np
+import pandas as pd
+
+
+class UserIndex:
+    """
+    Shared dictionary mapping usernames to dense int32 codes.
+    Missing users (None/NaN) always encode to -1 and decode to None.
+    """
+
+    def __init__(self, names=()):
+        self.names = np.asarray(list(names), dtype=object)
+        self._index = pd.Index(self.names, dtype=object)
+
+    def __len__(self):
+        return len(self.names)
+
+    def encode(self, values, add=True):
+        """
+        Encode usernames as int32 codes. Unknown names are appended to the
+        dictionary if `add`, otherwise encoded as -1.
+        """
+        values = pd.Series(np.asarray(values, dtype=object))
+        codes = self._index.get_indexer(values)
+        unknown = (codes < 0) & values.notna().to_numpy()
+        if add and unknown.any():
+            new_names = values[unknown].unique()
+            self.names = np.concatenate([self.names, np.asarray(new_names, dtype=object)])
+            self._index = pd.Index(self.names, dtype=object)
+            codes[unknown] = self._index.get_indexer(values[unknown])
+        return codes.astype(np.int32)
+
+    def decode(self, codes):
+        """Decode int codes back to usernames (None for -1)."""
+        codes = np.asarray(codes)
+        names = np.append(self.names, None)
+        return names[np.where(codes < 0, len(self.names), codes)]
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self.names.tolist(), f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls(pickle.load(f))
+
+
+def encode_columns(df, user_index, columns, add=True):
+    """Return a copy of df with the given username columns replaced by int32 codes."""
+    df = df.copy()
+    for col in columns:
+        df[col] = user_index.encode(df[col], add=add)
+    return df
+
+
+def decode_columns(df, user_index, columns):
+    """Return a copy of df with the given code columns decoded to usernames."""
+    df = df.copy()
+    for col in columns:
+        df[col] = user_index.decode(df[col])
+    return df
+
+
+def encode_diffusion(diffusion_df, user_index):
+    """Encode the user columns of a diffusion frame (Source, Target and refu if present)."""
+    columns = [col for col in ["Source", "Target", "refu"] if col in diffusion_df.columns]
+    return encode_columns(diffusion_df, user_index, columns)
+
+
+def encode_id_table(df, user_index, id_col="Id"):
+    """Encode the user column of a node table such as the modularity or centrality CSVs."""
+    return encode_columns(df, user_index, [id_col])
+
+
+def encode_following(following_dict, user_index):
+    """Encode a following dict as {user code: int32 array of lowercase followed user codes}."""
+    return {
+        int(code): user_index.encode([str(x).lower() for x in following])
+        for code, following in zip(user_index.encode(list(following_dict)), following_dict.values())
+    }
+
+
+def as_codes(values, user_index, add=False):
+    """
+    Codes for a column that may hold usernames or already-encoded integers.
+    Unknown names are added to the index if `add`, otherwise encoded as -1.
+    """
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.integer):
+        return values
+    return user_index.encode(values, add=add)